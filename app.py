@@ -1,60 +1,212 @@
-from flask import Flask, redirect, request, jsonify, session, url_for
+from flask import Flask, redirect, request, jsonify, session, url_for, g
 from flask import send_file
 import base64
 import hashlib
+import hmac
+import mmap
+import tempfile
 import os
 import urllib.parse
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from twilio.twiml.messaging_response import MessagingResponse
-from twilio.rest import Client
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
-import binascii
 import json
-from dotenv import load_dotenv
 import logging
 import time
 import re
+import textwrap
+import calendar
+import itertools
+import functools
+from concurrent.futures import ThreadPoolExecutor, Future
+import threading
+import queue
+import sqlite3
+import secrets
+import random
+import contextvars
+from contextlib import contextmanager
+from collections import OrderedDict, namedtuple
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
 app = Flask(__name__)
-app.secret_key = binascii.hexlify(os.urandom(24)).decode()
 
-# Load environment variables from the .env file
-load_dotenv()
+# Load environment variables from the .env file next to this module (python-dotenv is only imported when there is one)
+DOTENV_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.env')
+if os.path.exists(DOTENV_PATH):
+    from dotenv import load_dotenv
+    load_dotenv(DOTENV_PATH)
 
 # Configurations
+# Signs Flask sessions; every worker must use the same key. Without it one is generated
+# and shared through the database, which only works while all workers share DATABASE_PATH
+SECRET_KEY = os.environ.get('SECRET_KEY')
 CLIENT_ID = os.environ.get('CLIENT_ID')
 CLIENT_SECRET = os.environ.get('CLIENT_SECRET')
-REDIRECT_URI = 'https://instacanva.onrender.com/callback'
+APP_URL = os.environ.get('APP_URL', 'https://instacanva.onrender.com')
+REDIRECT_URI = f'{APP_URL}/callback'
+# Upstream base URLs (overridable so benchmarks can point the app at local stand-ins)
+CANVA_API_URL = os.environ.get('CANVA_API_URL', 'https://api.canva.com/rest/v1')
+CANVA_TOKEN_URL = f'{CANVA_API_URL}/oauth/token'
 SCOPE = 'app:read design:content:read design:meta:read design:content:write design:permission:read design:permission:write folder:read folder:write folder:permission:read folder:permission:write asset:read asset:write comment:read comment:write brandtemplate:meta:read brandtemplate:content:read profile:read'
 CODE_CHALLENGE_METHOD = 'S256'
 
 # Define the URL for IBM token generation and the API key
-TOKEN_URL = 'https://iam.cloud.ibm.com/identity/token'
+IBM_IAM_URL = os.environ.get('IBM_IAM_URL', 'https://iam.cloud.ibm.com')
+TOKEN_URL = f'{IBM_IAM_URL}/identity/token'
 API_KEY = os.environ.get('IBM_API_KEY')
 
+# Refresh the cached IBM token this many seconds before it expires
+IBM_TOKEN_REFRESH_MARGIN = int(os.environ.get('IBM_TOKEN_REFRESH_MARGIN', 300))
+
 # IBM Watson Model URL
-IBM_MODEL_URL = "https://us-south.ml.cloud.ibm.com/ml/v1/text/generation?version=2023-05-29"
+WATSONX_URL = os.environ.get('WATSONX_URL', 'https://us-south.ml.cloud.ibm.com')
+IBM_MODEL_URL = f"{WATSONX_URL}/ml/v1/text/generation?version=2023-05-29"
+IBM_MODEL_ID = "ibm/granite-13b-chat-v2"
+IBM_PROJECT_ID = "6ca88f8a-cc72-44d0-8f4a-8ceaf9e66c03"
+IBM_GENERATION_PARAMETERS = {
+    "decoding_method": "greedy",
+    "repetition_penalty": 1,
+    # Stop as soon as the model starts making up the user's next turn
+    "stop_sequences": ["Input:"],
+    "include_stop_sequence": False
+}
+# max_new_tokens per kind of chat message (a full WhatsApp message is roughly 400 tokens)
+CHAT_TOKEN_BUDGETS = {
+    'smalltalk': int(os.environ.get('CHAT_SMALLTALK_MAX_TOKENS', 80)),
+    'chat': int(os.environ.get('CHAT_MAX_TOKENS', 200)),
+    'ideas': int(os.environ.get('CHAT_IDEAS_MAX_TOKENS', 400)),
+}
+# Earlier exchanges sent along with each prompt, each side trimmed to this many characters
+CHAT_HISTORY_TURNS = int(os.environ.get('CHAT_HISTORY_TURNS', 2))
+CHAT_HISTORY_CHARS = int(os.environ.get('CHAT_HISTORY_CHARS', 300))
+IBM_STREAM_URL = f"{WATSONX_URL}/ml/v1/text/generation_stream?version=2023-05-29"
+
+# Streamed chatbot replies: ack the webhook at once and send the answer over the REST API
+CHAT_STREAMING = os.environ.get('CHAT_STREAMING', 'true').lower() == 'true'
+CHAT_WORKERS = int(os.environ.get('CHAT_WORKERS', 8))
+# Send the first message as soon as this much text ends on a sentence boundary
+CHAT_FIRST_REPLY_CHARS = int(os.environ.get('CHAT_FIRST_REPLY_CHARS', 80))
+# Later messages wait for at least this much text
+CHAT_REPLY_CHUNK_CHARS = int(os.environ.get('CHAT_REPLY_CHUNK_CHARS', 600))
+# Cache of chatbot replies for repeated prompts (greedy decoding is deterministic)
+CHAT_CACHE_TTL = int(os.environ.get('CHAT_CACHE_TTL', 24 * 60 * 60))
+CHAT_CACHE_SIZE = int(os.environ.get('CHAT_CACHE_SIZE', 2048))
+CHAT_CACHE_PERSIST = os.environ.get('CHAT_CACHE_PERSIST', 'true').lower() == 'true'
+
+# WhatsApp bodies are capped at 1600 characters
+WHATSAPP_MAX_CHARS = 1500
 
 # SendGrid configuration
 sendgrid_api_key = os.environ.get('SENDGRID_API_KEY')
 sendgrid_from_email = os.environ.get('SENDGRID_MAIL')
+SENDGRID_API_URL = os.environ.get('SENDGRID_API_URL', 'https://api.sendgrid.com')
 
 # Twilio configuration
 twilio_account_sid = os.getenv('TWILIO_ACCOUNT_SID')
 twilio_auth_token = os.getenv('TWILIO_AUTH_TOKEN')
 twilio_phone_number = os.getenv('TWILIO_PHONE_NO')
-client = Client(twilio_account_sid, twilio_auth_token)
+TWILIO_BASE_URL = os.environ.get('TWILIO_BASE_URL', 'https://api.twilio.com')
+TWILIO_API_URL = f'{TWILIO_BASE_URL}/2010-04-01'
+
+# Export pipeline configuration
+EXPORT_WORKERS = int(os.environ.get('EXPORT_WORKERS', 4))
+EXPORT_TIMEOUT = int(os.environ.get('EXPORT_TIMEOUT', 120))
+
+# How many search results are exported per request, and how many exports run at once
+EXPORT_TOP_N = int(os.environ.get('EXPORT_TOP_N', 3))
+EXPORT_FANOUT_WORKERS = int(os.environ.get('EXPORT_FANOUT_WORKERS', 8))
+# Twilio's webhook lists at most 10 attached files (MediaUrl0 to MediaUrl9)
+TWILIO_MAX_INCOMING_MEDIA = 10
+# WhatsApp delivers one media file per outbound message, so several files go out as several messages
+WHATSAPP_MAX_MEDIA_PER_MESSAGE = 1
+# Files sent back for one export request, one WhatsApp message each
+EXPORT_MAX_FILES = int(os.environ.get('EXPORT_MAX_FILES', 10))
+
+# Canva export download URLs are signed and stay valid for about a day
+EXPORT_URL_TTL = int(os.environ.get('EXPORT_URL_TTL', 24 * 60 * 60))
+EXPORT_URL_SAFETY_MARGIN = int(os.environ.get('EXPORT_URL_SAFETY_MARGIN', 10 * 60))
+EXPORT_CACHE_SIZE = int(os.environ.get('EXPORT_CACHE_SIZE', 256))
+
+# Outbound HTTP configuration
+WEB_THREADS = int(os.environ.get('WEB_THREADS', 4))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 5))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 30))
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', 3))
+IBM_GENERATION_TIMEOUT = float(os.environ.get('IBM_GENERATION_TIMEOUT', 60))
+
+# Media upload limits
+MEDIA_MAX_BYTES = int(os.environ.get('MEDIA_MAX_BYTES', 50 * 1024 * 1024))
+MEDIA_CHUNK_SIZE = int(os.environ.get('MEDIA_CHUNK_SIZE', 64 * 1024))
+ASSET_UPLOAD_TIMEOUT = int(os.environ.get('ASSET_UPLOAD_TIMEOUT', 60))
+# Album uploads: files ingested at once per process, per sender, and queued per sender at most
+UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', 8))
+UPLOAD_PER_USER_CONCURRENCY = int(os.environ.get('UPLOAD_PER_USER_CONCURRENCY', 3))
+UPLOAD_MAX_QUEUED_PER_USER = int(os.environ.get('UPLOAD_MAX_QUEUED_PER_USER', 30))
+# Upload dedupe: downloads are held in memory up to this size (then on disk) while they are hashed,
+# and each sender's index remembers this many assets for at most ASSET_INDEX_TTL seconds
+MEDIA_SPOOL_MEMORY = int(os.environ.get('MEDIA_SPOOL_MEMORY', 1024 * 1024))
+ASSET_INDEX_PER_USER = int(os.environ.get('ASSET_INDEX_PER_USER', 500))
+ASSET_INDEX_TTL = int(os.environ.get('ASSET_INDEX_TTL', 90 * 24 * 60 * 60))
+
+# Multi-turn conversations (asking for a design type, a title, or which result to export)
+CONVERSATION_TTL = int(os.environ.get('CONVERSATION_TTL', 10 * 60))
+
+# Design listing and metadata cache
+DESIGN_CACHE_TTL = int(os.environ.get('DESIGN_CACHE_TTL', 60))
+DESIGN_CACHE_SIZE = int(os.environ.get('DESIGN_CACHE_SIZE', 512))
+
+# Background notification dispatcher (SendGrid emails and Twilio sends)
+NOTIFY_WORKERS = int(os.environ.get('NOTIFY_WORKERS', 2))
+NOTIFY_QUEUE_SIZE = int(os.environ.get('NOTIFY_QUEUE_SIZE', 1000))
+NOTIFY_POLL_INTERVAL = float(os.environ.get('NOTIFY_POLL_INTERVAL', 5))
+NOTIFY_DIGEST_WINDOW = int(os.environ.get('NOTIFY_DIGEST_WINDOW', 120))
+NOTIFY_MAX_ATTEMPTS = int(os.environ.get('NOTIFY_MAX_ATTEMPTS', 6))
+NOTIFY_RETRY_BASE = float(os.environ.get('NOTIFY_RETRY_BASE', 5))
+NOTIFY_RETRY_MAX = float(os.environ.get('NOTIFY_RETRY_MAX', 300))
+# Notifications that ran out of attempts are kept this long for inspection, then deleted
+NOTIFY_FAILED_RETENTION = int(os.environ.get('NOTIFY_FAILED_RETENTION', 7 * 24 * 3600))
+
+# Persistent storage shared by all worker processes
+DATABASE_PATH = os.environ.get('DATABASE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instacanva.db'))
+
+# Thumbnails of recently used designs, kept on disk next to the database and served to Twilio from /thumbnails
+THUMBNAIL_CACHE_DIR = os.environ.get('THUMBNAIL_CACHE_DIR', os.path.join(os.path.dirname(DATABASE_PATH), 'thumbnails'))
+THUMBNAIL_CACHE_BYTES = int(os.environ.get('THUMBNAIL_CACHE_BYTES', 64 * 1024 * 1024))
+THUMBNAIL_MAX_BYTES = int(os.environ.get('THUMBNAIL_MAX_BYTES', 1024 * 1024))
+# After authentication this many of the user's most recently modified designs are prefetched
+PREFETCH_DESIGNS = int(os.environ.get('PREFETCH_DESIGNS', 10))
+PREFETCH_WORKERS = int(os.environ.get('PREFETCH_WORKERS', 2))
+
+# Keep-alive connections per upstream host: one for every thread that can be calling out at once,
+# so no pool ever has to open (and then throw away) connections beyond it
+HTTP_POOL_SIZE = int(os.environ.get(
+    'HTTP_POOL_SIZE',
+    WEB_THREADS + EXPORT_WORKERS + EXPORT_FANOUT_WORKERS + CHAT_WORKERS + UPLOAD_WORKERS + PREFETCH_WORKERS + NOTIFY_WORKERS
+))
+
+# Canva token store configuration
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+CANVA_TOKEN_REFRESH_MARGIN = int(os.environ.get('CANVA_TOKEN_REFRESH_MARGIN', 300))
+AUTH_LINK_TTL = int(os.environ.get('AUTH_LINK_TTL', 30 * 60))
+
+# Request tracing: timings always feed /metrics; this fraction of requests is also logged span by span
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', 0.01))
+
+# Admission control: each sender gets a token bucket of RATE_LIMIT_BURST messages refilled at
+# RATE_LIMIT_PER_MINUTE, and each worker process runs at most this many exports and Watsonx generations
+RATE_LIMIT_BURST = int(os.environ.get('RATE_LIMIT_BURST', 10))
+RATE_LIMIT_PER_MINUTE = float(os.environ.get('RATE_LIMIT_PER_MINUTE', 30))
+EXPORT_MAX_IN_FLIGHT = int(os.environ.get('EXPORT_MAX_IN_FLIGHT', 64))
+WATSONX_MAX_IN_FLIGHT = int(os.environ.get('WATSONX_MAX_IN_FLIGHT', 16))
 
 # RECIPIENT info
 RECIPIENT_MAIL = os.environ.get('RECIPIENT_MAIL')
 RECIPIENT_NO = os.environ.get('RECIPIENT_NO')
 
-Token_Response = dict()
-
 def generate_code_verifier():
     """Generate a random code verifier."""
     return base64.urlsafe_b64encode(os.urandom(32)).decode('utf-8').rstrip('=')
@@ -65,8 +217,484 @@ def generate_code_challenge(code_verifier):
     code_challenge_bytes = hashlib.sha256(code_verifier_bytes).digest()
     return base64.urlsafe_b64encode(code_challenge_bytes).decode('utf-8').rstrip('=')
 
-# Function to get the bearer token
-def get_ibm_bearer_token(api_key):
+# Metrics collectors, each returning a list of Prometheus exposition lines
+METRICS_COLLECTORS = []
+
+def register_metrics(collector):
+    """Register a function whose output is included in the /metrics endpoint."""
+    METRICS_COLLECTORS.append(collector)
+    return collector
+
+class Histogram:
+    """Minimal cumulative histogram rendered in the Prometheus text format."""
+
+    def __init__(self, name, buckets):
+        self.name = name
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def lines(self, labels=''):
+        label_prefix = f'{labels},' if labels else ''
+        lines = []
+        for bound, bucket_count in zip(self.buckets, self.counts):
+            lines.append(f'{self.name}_bucket{{{label_prefix}le="{bound}"}} {bucket_count}')
+        lines.append(f'{self.name}_bucket{{{label_prefix}le="+Inf"}} {self.count}')
+        lines.append(f'{self.name}_sum{{{labels}}} {self.sum}' if labels else f'{self.name}_sum {self.sum}')
+        lines.append(f'{self.name}_count{{{labels}}} {self.count}' if labels else f'{self.name}_count {self.count}')
+        return lines
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after a TTL.
+
+    Keys are tuples whose first element identifies the owner, so everything cached for
+    one user can be dropped at once. Each entry remembers how long the upstream call
+    that produced it took, which is counted as saved time on every hit.
+    """
+
+    def __init__(self, name, ttl, capacity):
+        self.name = name
+        self.ttl = ttl
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0, 'saved_seconds': 0.0}
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    del self.entries[key]
+                self.stats['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            self.stats['saved_seconds'] += entry[2]
+            return entry[1]
+
+    def set(self, key, value, latency=0.0, ttl=None):
+        with self.lock:
+            self.entries[key] = (time.time() + (self.ttl if ttl is None else ttl), value, latency)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def invalidate(self, owner):
+        """Drop every entry whose key starts with owner."""
+        with self.lock:
+            stale = [key for key in self.entries if key[0] == owner]
+            for key in stale:
+                del self.entries[key]
+            self.stats['invalidations'] += len(stale)
+
+    def lines(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        labels = f'cache="{self.name}"'
+        lines = [
+            f"instacanva_cache_entries{{{labels}}} {len(self.entries)}",
+            f"instacanva_cache_hit_ratio{{{labels}}} {self.stats['hits'] / lookups if lookups else 0}",
+        ]
+        for stat, value in self.stats.items():
+            lines.append(f"instacanva_cache_{stat}_total{{{labels}}} {value}")
+        return lines
+
+CACHES = []
+
+def register_cache(cache):
+    """Track a cache so its statistics show up on /metrics."""
+    CACHES.append(cache)
+    return cache
+
+@register_metrics
+def cache_metrics():
+    lines = [
+        "# TYPE instacanva_cache_entries gauge",
+        "# TYPE instacanva_cache_hit_ratio gauge",
+    ]
+    for cache in CACHES:
+        lines.extend(cache.lines())
+    return lines
+
+class SingleFlight:
+    """Collapse concurrent calls that share a key into a single execution.
+
+    The first caller (the leader) runs the function; callers arriving while it runs
+    wait for and share its result or exception.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.stats = {'leaders': 0, 'followers': 0}
+
+    def do(self, key, fn):
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+                self.stats['leaders'] += 1
+            else:
+                self.stats['followers'] += 1
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn()
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+
+FLIGHTS = []
+
+def register_flight(flight):
+    """Track a SingleFlight so its coalescing statistics show up on /metrics."""
+    FLIGHTS.append(flight)
+    return flight
+
+@register_metrics
+def flight_metrics():
+    lines = [
+        "# TYPE instacanva_singleflight_leaders_total counter",
+        "# TYPE instacanva_singleflight_followers_total counter",
+    ]
+    for flight in FLIGHTS:
+        lines.append(f'instacanva_singleflight_leaders_total{{group="{flight.name}"}} {flight.stats["leaders"]}')
+        lines.append(f'instacanva_singleflight_followers_total{{group="{flight.name}"}} {flight.stats["followers"]}')
+    return lines
+
+# Bounded thread pools for background work, created lazily so each Gunicorn worker gets its own
+executors = {}
+executors_lock = threading.Lock()
+
+def get_executor(name, max_workers):
+    """Return the named thread pool, creating it once per process."""
+    with executors_lock:
+        executor, pid = executors.get(name, (None, None))
+        if executor is None or pid != os.getpid():
+            executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+            executors[name] = (executor, os.getpid())
+        return executor
+
+# Flows shared with asgi.py (the *_steps generators) are written once: each upstream or SQLite
+# call is yielded as io.<call>(...) and its result is sent back in. BlockingIO makes the calls
+# directly on the current thread; asgi.AsyncIO turns them into awaitables for the event loop.
+def run_steps(steps):
+    """Run a *_steps generator with BlockingIO to completion and return its result."""
+    result = None
+    while True:
+        try:
+            result = steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+
+# Tracing: route handlers, background jobs and every upstream call are timed into histograms.
+# A sampled fraction of traces is also logged as one JSON line listing all of its spans,
+# which shows whether a slow reply was spent in IAM, Watsonx, Canva, export polling or SendGrid.
+current_trace = contextvars.ContextVar('current_trace', default=None)
+handler_latency = {}
+upstream_latency = {}
+upstream_responses = {}
+upstream_lock = threading.Lock()
+poll_iterations = {
+    kind: Histogram('instacanva_poll_iterations', [1, 2, 3, 5, 8, 13, 21, 34])
+    for kind in ('export', 'asset_upload')
+}
+
+class Trace:
+    """Spans recorded while handling one request or background job."""
+
+    def __init__(self, name, sampled):
+        self.trace_id = secrets.token_hex(8) if sampled else None
+        self.name = name
+        self.sampled = sampled
+        self.started = time.perf_counter()
+        self.attributes = {}
+        self.spans = []
+
+def start_trace(name):
+    """Start a trace and make it current, returning it with the token needed by finish_trace."""
+    trace = Trace(name, random.random() < TRACE_SAMPLE_RATE)
+    return trace, current_trace.set(trace)
+
+def finish_trace(trace, token):
+    duration = time.perf_counter() - trace.started
+    current_trace.reset(token)
+    histogram = handler_latency.get(trace.name)
+    if histogram is None:
+        histogram = handler_latency.setdefault(
+            trace.name, Histogram('instacanva_handler_seconds', [0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120])
+        )
+    histogram.observe(duration)
+    if trace.sampled:
+        logging.info("trace " + json.dumps({
+            'trace_id': trace.trace_id,
+            'name': trace.name,
+            'duration_ms': round(duration * 1000, 2),
+            **trace.attributes,
+            'spans': trace.spans,
+        }))
+
+@contextmanager
+def traced(name, **attributes):
+    """Run a background job (an export, a streamed reply, a notification) as its own trace; also works as a decorator."""
+    trace, token = start_trace(name)
+    trace.attributes.update(attributes)
+    try:
+        yield trace
+    finally:
+        finish_trace(trace, token)
+
+class UpstreamSpan:
+    """Handed to the body of upstream_span, which sets status to the HTTP status it got."""
+
+    def __init__(self):
+        self.status = 'ok'
+
+@contextmanager
+def upstream_span(upstream, operation):
+    """Time one upstream call into the latency histograms and the current trace."""
+    span = UpstreamSpan()
+    started = time.perf_counter()
+    try:
+        yield span
+    except Exception as e:
+        span.status = getattr(e, 'status_code', None) or getattr(e, 'status', None) or 'error'
+        raise
+    finally:
+        duration = time.perf_counter() - started
+        key = (upstream, operation)
+        histogram = upstream_latency.get(key)
+        if histogram is None:
+            histogram = upstream_latency.setdefault(
+                key, Histogram('instacanva_upstream_seconds', [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60])
+            )
+        histogram.observe(duration)
+        status_key = (upstream, operation, str(span.status))
+        with upstream_lock:
+            upstream_responses[status_key] = upstream_responses.get(status_key, 0) + 1
+        trace = current_trace.get()
+        if trace is not None and trace.sampled:
+            trace.spans.append({
+                'name': f'{upstream}.{operation}',
+                'status': span.status,
+                'start_ms': round((started - trace.started) * 1000, 2),
+                'duration_ms': round(duration * 1000, 2),
+            })
+
+@register_metrics
+def tracing_metrics():
+    lines = ["# TYPE instacanva_handler_seconds histogram"]
+    for name, histogram in list(handler_latency.items()):
+        lines.extend(histogram.lines(f'handler="{name}"'))
+    lines.append("# TYPE instacanva_upstream_seconds histogram")
+    for (upstream, operation), histogram in list(upstream_latency.items()):
+        lines.extend(histogram.lines(f'upstream="{upstream}",operation="{operation}"'))
+    lines.append("# TYPE instacanva_upstream_responses_total counter")
+    for (upstream, operation, status), count in list(upstream_responses.items()):
+        lines.append(f'instacanva_upstream_responses_total{{upstream="{upstream}",operation="{operation}",status="{status}"}} {count}')
+    lines.append("# TYPE instacanva_poll_iterations histogram")
+    for kind, histogram in poll_iterations.items():
+        lines.extend(histogram.lines(f'kind="{kind}"'))
+    lines.append("# TYPE instacanva_executor_queue_depth gauge")
+    for name, (executor, pid) in list(executors.items()):
+        if pid == os.getpid():
+            lines.append(f'instacanva_executor_queue_depth{{pool="{name}"}} {executor._work_queue.qsize()}')
+    return lines
+
+@app.before_request
+def start_request_trace():
+    g.trace, g.trace_token = start_trace(request.url_rule.rule if request.url_rule else 'unmatched')
+
+@app.after_request
+def record_response_status(response):
+    trace = g.get('trace')
+    if trace is not None:
+        trace.attributes['status'] = response.status_code
+    return response
+
+@app.teardown_request
+def finish_request_trace(error=None):
+    trace = g.pop('trace', None)
+    if trace is not None:
+        finish_trace(trace, g.pop('trace_token'))
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter that keeps a keep-alive pool per host and applies default timeouts."""
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+        return super().send(request, **kwargs)
+
+# Replayed on these statuses; a plain 500 may have done work already
+RETRY_STATUSES = (429, 502, 503, 504)
+
+def may_replay(method, status=None):
+    """Whether a request that failed with status (None: the connection dropped after sending) can be sent again.
+
+    A 502/504 or a dropped connection can come after Canva already created the design or
+    rotated the refresh token, so a POST is only replayed when it was throttled.
+    """
+    if method.upper() in Retry.DEFAULT_ALLOWED_METHODS:
+        return status is None or status in RETRY_STATUSES
+    return status == 429
+
+class UpstreamRetry(Retry):
+    """urllib3 retry policy that consults may_replay for status retries."""
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        return may_replay(method, status_code) and super().is_retry(method, status_code, has_retry_after)
+
+def create_http_session(max_retries=HTTP_MAX_RETRIES):
+    """Build a pooled session for Canva, IBM and media calls."""
+    retry = UpstreamRetry(
+        total=max_retries,
+        # Connection failures are always safe to retry: nothing reached the upstream
+        connect=max_retries,
+        read=0,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=None,
+        backoff_factor=0.5,
+        backoff_jitter=0.5,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = PooledHTTPAdapter(pool_connections=10, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+    http = requests.Session()
+    http.mount('https://', adapter)
+    http.mount('http://', adapter)
+    return http
+
+http_session = create_http_session()
+# Streamed request bodies cannot be replayed, so uploads get their own session without retries
+upload_http_session = create_http_session(max_retries=0)
+
+@register_metrics
+def http_pool_metrics():
+    lines = [
+        "# TYPE instacanva_http_pool_connections_total counter",
+        "# TYPE instacanva_http_pool_requests_total counter",
+        "# TYPE instacanva_http_pool_in_use_connections gauge",
+        "# TYPE instacanva_http_pool_max_connections gauge",
+    ]
+    for session_name, session_obj in (('default', http_session), ('upload', upload_http_session)):
+        adapter = session_obj.get_adapter('https://')
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            labels = f'session="{session_name}",host="{pool.host}"'
+            lines.append(f"instacanva_http_pool_connections_total{{{labels}}} {pool.num_connections}")
+            lines.append(f"instacanva_http_pool_requests_total{{{labels}}} {pool.num_requests}")
+            # The pool queue holds idle connections plus empty slots; whatever is missing is checked out
+            available = pool.pool.qsize() if pool.pool else 0
+            lines.append(f"instacanva_http_pool_in_use_connections{{{labels}}} {adapter._pool_maxsize - available}")
+            lines.append(f"instacanva_http_pool_max_connections{{{labels}}} {adapter._pool_maxsize}")
+    return lines
+
+class MediaTooLarge(Exception):
+    """Raised when an incoming media file exceeds MEDIA_MAX_BYTES."""
+
+class MediaStream:
+    """Chunk iterator over a streamed download (media files and thumbnails).
+
+    The download is read block by block, so only one chunk of the file is held in
+    memory at a time. The size cap is checked against Content-Length up front and
+    against the bytes actually received while streaming.
+    """
+
+    def __init__(self, response, max_bytes=MEDIA_MAX_BYTES, chunk_size=MEDIA_CHUNK_SIZE):
+        self.response = response
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.bytes_read = 0
+        content_length = response.headers.get('Content-Length')
+        if content_length is not None and int(content_length) > max_bytes:
+            raise MediaTooLarge(f"Media is {content_length} bytes, the limit is {max_bytes}")
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.chunk_size
+        chunk = self.response.raw.read(size)
+        self.bytes_read += len(chunk)
+        if self.bytes_read > self.max_bytes:
+            raise MediaTooLarge(f"Media exceeded the limit of {self.max_bytes} bytes")
+        return chunk
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+class SpooledMedia:
+    """A downloaded media file and its SHA-256, hashed as the chunks arrive.
+
+    The bytes stay in memory up to MEDIA_SPOOL_MEMORY and roll over to a temporary file
+    beyond that. Once rewound it is a file-like body requests can upload with a Content-Length.
+    """
+
+    def __init__(self, spool_memory=MEDIA_SPOOL_MEMORY, chunk_size=MEDIA_CHUNK_SIZE):
+        self.file = tempfile.SpooledTemporaryFile(max_size=spool_memory)
+        self.hash = hashlib.sha256()
+        self.chunk_size = chunk_size
+        self.len = 0
+
+    def write(self, chunk):
+        self.hash.update(chunk)
+        self.file.write(chunk)
+        self.len += len(chunk)
+
+    def digest(self):
+        return self.hash.digest()
+
+    def rewind(self):
+        self.file.seek(0)
+
+    def read(self, size=-1):
+        return self.file.read(self.chunk_size if size is None or size < 0 else size)
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# Function to fetch a fresh bearer token from IBM IAM
+def fetch_ibm_bearer_token(api_key):
+    """Request a new IAM token and return it together with its expiry timestamp."""
     data = {
         'grant_type': 'urn:ibm:params:oauth:grant-type:apikey',
         'apikey': api_key
@@ -74,17 +702,694 @@ def get_ibm_bearer_token(api_key):
     headers = {
         'Content-Type': 'application/x-www-form-urlencoded'
     }
-    response = requests.post(TOKEN_URL, data=data, headers=headers)
+    with upstream_span('ibm_iam', 'token') as span:
+        response = http_session.post(TOKEN_URL, data=data, headers=headers)
+        span.status = response.status_code
 
     if response.status_code == 200:
         token_info = response.json()
-        return token_info.get('access_token')
+        # IAM returns an absolute "expiration" and a relative "expires_in"; prefer the former
+        if token_info.get('expiration'):
+            expires_at = float(token_info['expiration'])
+        else:
+            expires_at = time.time() + float(token_info.get('expires_in', 3600))
+        return token_info.get('access_token'), expires_at
     else:
         raise Exception(f"Failed to obtain token: {response.status_code}\n{response.text}")
 
+class IBMTokenProvider:
+    """Process-wide cache for an IBM IAM bearer token.
+
+    The token is reused until it gets close to expiry. Inside the refresh margin the
+    cached token is still served while a single background thread renews it, and only
+    one thread at a time ever talks to IAM.
+    """
+
+    def __init__(self, api_key, refresh_margin=IBM_TOKEN_REFRESH_MARGIN):
+        self.api_key = api_key
+        self.refresh_margin = refresh_margin
+        self.token = None
+        self.expires_at = 0
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'refreshes': 0, 'errors': 0}
+
+    def get_token(self):
+        """Return a valid bearer token, fetching one only when none is usable."""
+        now = time.time()
+        token, expires_at = self.token, self.expires_at
+        if token and now < expires_at:
+            self.stats['hits'] += 1
+            if now >= expires_at - self.refresh_margin:
+                self._refresh_in_background()
+            return token
+
+        with self.lock:
+            # Another thread may have fetched the token while we waited for the lock
+            if self.token and time.time() < self.expires_at:
+                self.stats['hits'] += 1
+                return self.token
+            self.stats['misses'] += 1
+            self._fetch()
+            return self.token
+
+    def _fetch(self):
+        try:
+            self.token, self.expires_at = fetch_ibm_bearer_token(self.api_key)
+        except Exception:
+            self.stats['errors'] += 1
+            raise
+
+    def _refresh_in_background(self):
+        # Never block the caller: if a refresh is already running, keep serving the cached token
+        if not self.refresh_lock.acquire(blocking=False):
+            return
+        threading.Thread(target=self._background_refresh, daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            with self.lock:
+                self.stats['refreshes'] += 1
+                self._fetch()
+        except Exception as e:
+            logging.error(f"Background IBM token refresh failed: {e}")
+        finally:
+            self.refresh_lock.release()
+
+ibm_token_providers = {}
+ibm_token_providers_lock = threading.Lock()
+
+# Function to get the bearer token
+def get_ibm_bearer_token(api_key):
+    """Return a cached IBM bearer token for the given API key."""
+    provider = ibm_token_providers.get(api_key)
+    if provider is None:
+        with ibm_token_providers_lock:
+            provider = ibm_token_providers.setdefault(api_key, IBMTokenProvider(api_key))
+    return provider.get_token()
+
+@register_metrics
+def ibm_token_metrics():
+    lines = []
+    for name in ('hits', 'misses', 'refreshes', 'errors'):
+        total = sum(p.stats[name] for p in ibm_token_providers.values())
+        lines.append(f"# TYPE instacanva_ibm_token_{name}_total counter")
+        lines.append(f"instacanva_ibm_token_{name}_total {total}")
+    return lines
+
+# SQLite connections are opened lazily per thread (and per process, so a Gunicorn fork never shares one)
+db_local = threading.local()
+
+DB_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS canva_tokens (
+        user_id TEXT PRIMARY KEY,
+        access_token TEXT NOT NULL,
+        refresh_token TEXT,
+        expires_at REAL NOT NULL,
+        refresh_lease_until REAL NOT NULL DEFAULT 0
+    )""",
+    """CREATE TABLE IF NOT EXISTS auth_links (
+        state TEXT PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        code_verifier TEXT,
+        created_at REAL NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS chat_replies (
+        cache_key TEXT PRIMARY KEY,
+        reply TEXT NOT NULL,
+        created_at REAL NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS chat_replies_created_at ON chat_replies (created_at)",
+    """CREATE TABLE IF NOT EXISTS notifications (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        digest_key TEXT,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at REAL NOT NULL,
+        claimed_until REAL NOT NULL DEFAULT 0,
+        created_at REAL NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS notifications_due ON notifications (status, next_attempt_at)",
+    """CREATE TABLE IF NOT EXISTS conversations (
+        user_id TEXT PRIMARY KEY,
+        state TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS chat_history (
+        user_id TEXT PRIMARY KEY,
+        turns TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    ) WITHOUT ROWID""",
+    """CREATE TABLE IF NOT EXISTS uploaded_assets (
+        user_id TEXT NOT NULL,
+        sha256 BLOB NOT NULL,
+        asset_id TEXT NOT NULL,
+        used_at REAL NOT NULL,
+        PRIMARY KEY (user_id, sha256)
+    ) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS uploaded_assets_used_at ON uploaded_assets (user_id, used_at)",
+    """CREATE TABLE IF NOT EXISTS thumbnails (
+        key TEXT PRIMARY KEY,
+        content_type TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        updated_at REAL NOT NULL,
+        used_at REAL NOT NULL
+    ) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS thumbnails_used_at ON thumbnails (used_at)",
+    """CREATE TABLE IF NOT EXISTS app_secrets (
+        name TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    ) WITHOUT ROWID""",
+    """CREATE TABLE IF NOT EXISTS rate_limits (
+        user_id TEXT PRIMARY KEY,
+        tokens REAL NOT NULL,
+        updated_at REAL NOT NULL
+    ) WITHOUT ROWID""",
+]
+
+def get_db():
+    """Return this thread's SQLite connection, creating it and the schema on first use."""
+    conn = getattr(db_local, 'conn', None)
+    if conn is None or db_local.pid != os.getpid():
+        conn = sqlite3.connect(DATABASE_PATH, timeout=30, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        for statement in DB_SCHEMA:
+            conn.execute(statement)
+        db_local.conn = conn
+        db_local.pid = os.getpid()
+    return conn
+
+def shared_secret_key(name='flask_secret_key'):
+    """Return a random secret generated by whichever worker asks first and shared by all of them."""
+    db = get_db()
+    db.execute('INSERT OR IGNORE INTO app_secrets (name, value) VALUES (?, ?)', (name, secrets.token_hex(32)))
+    return db.execute('SELECT value FROM app_secrets WHERE name = ?', (name,)).fetchone()[0]
+
+def get_secret_key():
+    """Return the key that signs sessions and names cached thumbnails, loading it on first use."""
+    if app.secret_key is None:
+        app.secret_key = SECRET_KEY or shared_secret_key()
+    return app.secret_key
+
+@app.before_request
+def load_secret_key():
+    # Resolved on the first request rather than at import, so importing the app opens no database
+    get_secret_key()
+
+class TokenStore:
+    """Canva OAuth tokens keyed by WhatsApp sender.
+
+    An in-process LRU answers the webhook hot path without any I/O; SQLite is the
+    source of truth shared by every worker. Tokens close to expiry are rotated with
+    their refresh token in the background, and a lease column makes sure only one
+    worker rotates a given token at a time.
+    """
+
+    def __init__(self, capacity=TOKEN_CACHE_SIZE, refresh_margin=CANVA_TOKEN_REFRESH_MARGIN):
+        self.capacity = capacity
+        self.refresh_margin = refresh_margin
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.refreshing = set()
+        self.stats = {'hits': 0, 'misses': 0, 'refreshes': 0, 'refresh_errors': 0}
+
+    def _cache_get(self, user_id):
+        with self.lock:
+            record = self.cache.get(user_id)
+            if record is not None:
+                self.cache.move_to_end(user_id)
+            return record
+
+    def _cache_put(self, user_id, record):
+        with self.lock:
+            self.cache[user_id] = record
+            self.cache.move_to_end(user_id)
+            while len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.cache.pop(user_id, None)
+
+    def load(self, user_id):
+        row = get_db().execute(
+            'SELECT access_token, refresh_token, expires_at FROM canva_tokens WHERE user_id = ?', (user_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {'access_token': row[0], 'refresh_token': row[1], 'expires_at': row[2]}
+
+    def save(self, user_id, token_response):
+        """Store the token response returned by Canva's /oauth/token endpoint."""
+        record = {
+            'access_token': token_response['access_token'],
+            'refresh_token': token_response.get('refresh_token'),
+            'expires_at': time.time() + float(token_response.get('expires_in', 14400)),
+        }
+        get_db().execute(
+            'INSERT OR REPLACE INTO canva_tokens (user_id, access_token, refresh_token, expires_at, refresh_lease_until) '
+            'VALUES (?, ?, ?, ?, 0)',
+            (user_id, record['access_token'], record['refresh_token'], record['expires_at'])
+        )
+        self._cache_put(user_id, record)
+        return record
+
+    def get(self, user_id):
+        """Return a usable Canva access token for the user, or None if they have not authenticated."""
+        if not user_id:
+            return None
+        record = self._cache_get(user_id)
+        if record is None:
+            self.stats['misses'] += 1
+            record = self.load(user_id)
+            if record is None:
+                return None
+            self._cache_put(user_id, record)
+        else:
+            self.stats['hits'] += 1
+
+        now = time.time()
+        if now >= record['expires_at']:
+            record = self.refresh(user_id)
+            return record['access_token'] if record else None
+        if now >= record['expires_at'] - self.refresh_margin:
+            self._refresh_in_background(user_id)
+        return record['access_token']
+
+    def _refresh_in_background(self, user_id):
+        with self.lock:
+            if user_id in self.refreshing:
+                return
+            self.refreshing.add(user_id)
+
+        def run():
+            try:
+                self.refresh(user_id)
+            except Exception as e:
+                logging.error(f"Background Canva token refresh failed: {e}")
+            finally:
+                with self.lock:
+                    self.refreshing.discard(user_id)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def refresh(self, user_id):
+        """Rotate the user's tokens unless another worker already did, returning the current record."""
+        record = self.load(user_id)
+        if record is None:
+            self.invalidate(user_id)
+            return None
+        now = time.time()
+        if now < record['expires_at'] - self.refresh_margin or not record['refresh_token']:
+            # Another worker already rotated the token (or there is nothing to rotate with)
+            self._cache_put(user_id, record)
+            return record if now < record['expires_at'] else None
+
+        claimed = get_db().execute(
+            'UPDATE canva_tokens SET refresh_lease_until = ? WHERE user_id = ? AND refresh_lease_until < ?',
+            (now + HTTP_CONNECT_TIMEOUT + HTTP_READ_TIMEOUT, user_id, now)
+        ).rowcount
+        if not claimed:
+            # Someone else holds the lease; the current token is still good until it expires
+            return record if now < record['expires_at'] else None
+
+        self.stats['refreshes'] += 1
+        try:
+            token_response = refresh_access_token(record['refresh_token'])
+        except Exception as e:
+            # Canva unreachable or answering with a non-JSON error page; release the lease below
+            token_response = {'error': str(e)}
+        if 'access_token' not in token_response:
+            self.stats['refresh_errors'] += 1
+            logging.error(f"Failed to refresh Canva token: {token_response.get('error')}")
+            get_db().execute('UPDATE canva_tokens SET refresh_lease_until = 0 WHERE user_id = ?', (user_id,))
+            return record if now < record['expires_at'] else None
+        return self.save(user_id, token_response)
+
+token_store = TokenStore()
+
+@register_metrics
+def token_store_metrics():
+    lines = [
+        "# TYPE instacanva_canva_token_cache_size gauge",
+        f"instacanva_canva_token_cache_size {len(token_store.cache)}",
+    ]
+    for name, value in token_store.stats.items():
+        lines.append(f"# TYPE instacanva_canva_token_{name}_total counter")
+        lines.append(f"instacanva_canva_token_{name}_total {value}")
+    return lines
+
+def create_auth_link(user_id):
+    """Create a one-time Canva authentication link tied to a WhatsApp sender."""
+    now = time.time()
+    state = secrets.token_urlsafe(24)
+    db = get_db()
+    db.execute('DELETE FROM auth_links WHERE created_at < ?', (now - AUTH_LINK_TTL,))
+    db.execute('INSERT INTO auth_links (state, user_id, created_at) VALUES (?, ?, ?)', (state, user_id, now))
+    return f"{APP_URL}/?state={state}"
+
+class ConversationStore:
+    """Per-sender conversation state shared by all workers through SQLite.
+
+    State is a small dict serialized as compact JSON, and it expires after
+    CONVERSATION_TTL seconds of inactivity.
+    """
+
+    def __init__(self, ttl=CONVERSATION_TTL):
+        self.ttl = ttl
+
+    def get(self, user_id):
+        row = get_db().execute(
+            'SELECT state FROM conversations WHERE user_id = ? AND expires_at >= ?', (user_id, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, user_id, state):
+        now = time.time()
+        db = get_db()
+        db.execute(
+            'INSERT OR REPLACE INTO conversations (user_id, state, expires_at) VALUES (?, ?, ?)',
+            (user_id, json.dumps(state, separators=(',', ':')), now + self.ttl)
+        )
+        db.execute('DELETE FROM conversations WHERE expires_at < ?', (now,))
+
+    def clear(self, user_id):
+        get_db().execute('DELETE FROM conversations WHERE user_id = ?', (user_id,))
+
+conversation_store = ConversationStore()
+
+class ChatHistory:
+    """The last few chatbot exchanges per sender, sent along with their next prompt.
+
+    Only `turns` exchanges are kept and each side is trimmed to `max_chars`, so the
+    prompt stays small however long the chat goes on. History expires like the
+    conversation state does.
+    """
+
+    def __init__(self, turns=CHAT_HISTORY_TURNS, max_chars=CHAT_HISTORY_CHARS, ttl=CONVERSATION_TTL):
+        self.turns = turns
+        self.max_chars = max_chars
+        self.ttl = ttl
+
+    def trim(self, text):
+        text = ' '.join(text.split())
+        if len(text) <= self.max_chars:
+            return text
+        return text[:self.max_chars].rsplit(' ', 1)[0] + '…'
+
+    def get(self, user_id):
+        """Return the sender's recent exchanges as a tuple of (message, reply) pairs, oldest first."""
+        if not user_id or self.turns <= 0:
+            return ()
+        row = get_db().execute(
+            'SELECT turns FROM chat_history WHERE user_id = ? AND expires_at >= ?', (user_id, time.time())
+        ).fetchone()
+        return tuple(tuple(turn) for turn in json.loads(row[0])) if row else ()
+
+    def add(self, user_id, message, reply):
+        if not user_id or self.turns <= 0 or not reply:
+            return
+        turns = list(self.get(user_id)) + [(self.trim(message), self.trim(reply))]
+        now = time.time()
+        db = get_db()
+        db.execute(
+            'INSERT OR REPLACE INTO chat_history (user_id, turns, expires_at) VALUES (?, ?, ?)',
+            (user_id, json.dumps(turns[-self.turns:], separators=(',', ':')), now + self.ttl)
+        )
+        db.execute('DELETE FROM chat_history WHERE expires_at < ?', (now,))
+
+chat_history = ChatHistory()
+
+class AssetIndex:
+    """Canva asset IDs of files a sender already uploaded, keyed by the SHA-256 of their content.
+
+    Digests are stored as raw 32-byte blobs in a WITHOUT ROWID table, so an entry costs
+    little more than the digest and the asset ID. Each sender keeps their `capacity` most
+    recently used entries, and entries unused for `ttl` seconds are dropped.
+    """
+
+    def __init__(self, capacity=ASSET_INDEX_PER_USER, ttl=ASSET_INDEX_TTL):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.stats = {'hits': 0, 'misses': 0, 'stale': 0}
+
+    def get(self, user_id, digest):
+        now = time.time()
+        db = get_db()
+        row = db.execute(
+            'SELECT asset_id FROM uploaded_assets WHERE user_id = ? AND sha256 = ? AND used_at >= ?',
+            (user_id, digest, now - self.ttl)
+        ).fetchone()
+        if row is None:
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        db.execute('UPDATE uploaded_assets SET used_at = ? WHERE user_id = ? AND sha256 = ?', (now, user_id, digest))
+        return row[0]
+
+    def add(self, user_id, digest, asset_id):
+        now = time.time()
+        db = get_db()
+        db.execute(
+            'INSERT OR REPLACE INTO uploaded_assets (user_id, sha256, asset_id, used_at) VALUES (?, ?, ?, ?)',
+            (user_id, digest, asset_id, now)
+        )
+        db.execute(
+            'DELETE FROM uploaded_assets WHERE user_id = ? AND (used_at < ? OR sha256 NOT IN ('
+            'SELECT sha256 FROM uploaded_assets WHERE user_id = ? ORDER BY used_at DESC LIMIT ?))',
+            (user_id, now - self.ttl, user_id, self.capacity)
+        )
+
+    def forget(self, user_id, digest):
+        self.stats['stale'] += 1
+        get_db().execute('DELETE FROM uploaded_assets WHERE user_id = ? AND sha256 = ?', (user_id, digest))
+
+asset_index = AssetIndex()
+
+BUSY_REPLY = "I'm a bit busy right now ⏳ Please try again in a minute."
+RATE_LIMITED_REPLY = "You're sending messages faster than I can keep up with ⏳ Please wait a few seconds and try again."
+
+admission_rejections = {'rate_limit': 0}
+
+class RateLimiter:
+    """Per-sender token buckets shared by all workers through SQLite.
+
+    Each check is a single UPSERT that refills the bucket for the time elapsed and takes a
+    token only if one is available, so concurrent workers never race on a read-modify-write.
+    A sender idle long enough for a full bucket is indistinguishable from one without a row,
+    so those rows are pruned now and then.
+    """
+
+    def __init__(self, burst=RATE_LIMIT_BURST, per_minute=RATE_LIMIT_PER_MINUTE):
+        self.burst = burst
+        self.rate = per_minute / 60
+
+    def allow(self, user_id):
+        if self.burst <= 0 or self.rate <= 0:
+            return True
+        now = time.time()
+        db = get_db()
+        admitted = db.execute(
+            'INSERT INTO rate_limits (user_id, tokens, updated_at) VALUES (:user_id, :burst - 1, :now) '
+            'ON CONFLICT (user_id) DO UPDATE SET tokens = MIN(:burst, tokens + (:now - updated_at) * :rate) - 1, updated_at = :now '
+            'WHERE MIN(:burst, tokens + (:now - updated_at) * :rate) >= 1',
+            {'user_id': user_id, 'burst': self.burst, 'rate': self.rate, 'now': now}
+        ).rowcount
+        if random.random() < 0.01:
+            db.execute('DELETE FROM rate_limits WHERE updated_at < ?', (now - self.burst / self.rate,))
+        if not admitted:
+            admission_rejections['rate_limit'] += 1
+        return bool(admitted)
+
+rate_limiter = RateLimiter()
+
+class ConcurrencyLimit:
+    """Non-blocking cap on work in flight against one upstream.
+
+    Callers that cannot get a slot are told to come back later right away, instead of
+    queueing behind work that would only finish after Twilio has given up on the webhook.
+    """
+
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        admission_rejections[name] = 0
+
+    def acquire(self):
+        with self.lock:
+            if self.in_flight >= self.limit:
+                admission_rejections[self.name] += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def release_after(self, fn, *args):
+        """Run fn with a slot acquired beforehand, releasing it when fn returns."""
+        try:
+            return fn(*args)
+        finally:
+            self.release()
+
+export_limit = ConcurrencyLimit('canva_export', EXPORT_MAX_IN_FLIGHT)
+watsonx_limit = ConcurrencyLimit('watsonx', WATSONX_MAX_IN_FLIGHT)
+
+def busy_reply(text=BUSY_REPLY):
+    resp = MessagingResponse()
+    resp.message(text)
+    return str(resp)
+
+@register_metrics
+def admission_metrics():
+    lines = ["# TYPE instacanva_admission_rejected_total counter"]
+    for reason, count in admission_rejections.items():
+        lines.append(f'instacanva_admission_rejected_total{{reason="{reason}"}} {count}')
+    lines.append("# TYPE instacanva_upstream_in_flight gauge")
+    for limit in (export_limit, watsonx_limit):
+        lines.append(f'instacanva_upstream_in_flight{{upstream="{limit.name}"}} {limit.in_flight}')
+    return lines
+
+@register_metrics
+def asset_index_metrics():
+    lines = []
+    for name, value in asset_index.stats.items():
+        lines.append(f"# TYPE instacanva_asset_index_{name}_total counter")
+        lines.append(f"instacanva_asset_index_{name}_total {value}")
+    return lines
+
+class ThumbnailCache:
+    """Design thumbnails on disk, bounded to `capacity` bytes across all users and workers.
+
+    Each thumbnail is one file named by an HMAC of the sender and design ID, so its URL
+    cannot be guessed. SQLite tracks sizes and last use; the least recently used files
+    are deleted once the total goes over capacity. Reads memory-map the file, so serving
+    a thumbnail copies nothing into Python beyond the chunk being written out.
+    """
+
+    def __init__(self, directory=THUMBNAIL_CACHE_DIR, capacity=THUMBNAIL_CACHE_BYTES):
+        self.directory = directory
+        self.capacity = capacity
+        self.stats = {'hits': 0, 'misses': 0, 'stored': 0, 'evicted': 0}
+
+    def key(self, user_id, design_id):
+        return hmac.new(get_secret_key().encode(), f'{user_id}\0{design_id}'.encode(), hashlib.sha256).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def updated_at(self, user_id, design_id):
+        """Return when the cached thumbnail's design was last modified, or None if it is not cached."""
+        row = get_db().execute('SELECT updated_at FROM thumbnails WHERE key = ?', (self.key(user_id, design_id),)).fetchone()
+        return row[0] if row else None
+
+    def urls(self, user_id, design_ids):
+        """Return the public URL of each design's cached thumbnail, or None where there is none."""
+        urls = []
+        for design_id in design_ids:
+            key = self.key(user_id, design_id)
+            if get_db().execute('SELECT 1 FROM thumbnails WHERE key = ?', (key,)).fetchone():
+                self.stats['hits'] += 1
+                urls.append(f"{APP_URL}/thumbnails/{key}")
+            else:
+                self.stats['misses'] += 1
+                urls.append(None)
+        return urls
+
+    def store(self, user_id, design_id, updated_at, content, content_type):
+        if not content:
+            return
+        key = self.key(user_id, design_id)
+        os.makedirs(self.directory, exist_ok=True)
+        # Written aside and renamed into place, so a reader never maps a half-written file
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as temp_file:
+            temp_file.write(content)
+        os.replace(temp_path, self.path(key))
+        now = time.time()
+        get_db().execute(
+            'INSERT OR REPLACE INTO thumbnails (key, content_type, size, updated_at, used_at) VALUES (?, ?, ?, ?, ?)',
+            (key, content_type, len(content), updated_at, now)
+        )
+        self.stats['stored'] += 1
+        self.evict()
+
+    def evict(self):
+        db = get_db()
+        excess = db.execute('SELECT COALESCE(SUM(size), 0) FROM thumbnails').fetchone()[0] - self.capacity
+        if excess <= 0:
+            return
+        for key, size in db.execute('SELECT key, size FROM thumbnails ORDER BY used_at').fetchall():
+            if excess <= 0:
+                break
+            self.forget(key)
+            self.stats['evicted'] += 1
+            excess -= size
+
+    def forget(self, key):
+        get_db().execute('DELETE FROM thumbnails WHERE key = ?', (key,))
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def open(self, key):
+        """Return (mapped file, content type) for a cached thumbnail, or None. The caller closes the map."""
+        db = get_db()
+        row = db.execute('SELECT content_type FROM thumbnails WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        try:
+            with open(self.path(key), 'rb') as thumbnail_file:
+                mapped = mmap.mmap(thumbnail_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            # The file was evicted by another worker (or is empty); drop what is left of the entry
+            self.forget(key)
+            return None
+        db.execute('UPDATE thumbnails SET used_at = ? WHERE key = ?', (time.time(), key))
+        return mapped, row[0]
+
+    def size(self):
+        return get_db().execute('SELECT COALESCE(SUM(size), 0), COUNT(*) FROM thumbnails').fetchone()
+
+thumbnail_cache = ThumbnailCache()
+
+@register_metrics
+def thumbnail_cache_metrics():
+    total_bytes, entries = thumbnail_cache.size()
+    lines = [
+        "# TYPE instacanva_thumbnail_cache_bytes gauge",
+        f"instacanva_thumbnail_cache_bytes {total_bytes}",
+        "# TYPE instacanva_thumbnail_cache_entries gauge",
+        f"instacanva_thumbnail_cache_entries {entries}",
+    ]
+    for name, value in thumbnail_cache.stats.items():
+        lines.append(f"# TYPE instacanva_thumbnail_cache_{name}_total counter")
+        lines.append(f"instacanva_thumbnail_cache_{name}_total {value}")
+    for name, value in prefetch_stats.items():
+        lines.append(f"# TYPE instacanva_prefetch_{name}_total counter")
+        lines.append(f"instacanva_prefetch_{name}_total {value}")
+    return lines
+
 @app.route('/')
 def index():
     """Generate authorization URL and redirect user."""
+    state = request.args.get('state')
+    link = None
+    if state:
+        link = get_db().execute(
+            'SELECT user_id FROM auth_links WHERE state = ? AND created_at >= ?', (state, time.time() - AUTH_LINK_TTL)
+        ).fetchone()
+    if link is None:
+        return jsonify({'error': 'Please open the authentication link sent to you on WhatsApp'}), 400
+
     code_verifier = generate_code_verifier()
     code_challenge = generate_code_challenge(code_verifier)
 
@@ -94,27 +1399,39 @@ def index():
         f"redirect_uri={urllib.parse.quote(REDIRECT_URI)}&"
         f"scope={urllib.parse.quote(SCOPE)}&"
         f"code_challenge={code_challenge}&"
-        f"code_challenge_method={CODE_CHALLENGE_METHOD}"
+        f"code_challenge_method={CODE_CHALLENGE_METHOD}&"
+        f"state={state}"
     )
 
-    session['code_verifier'] = code_verifier
+    # Keep the verifier next to the link so /callback works on any worker
+    get_db().execute('UPDATE auth_links SET code_verifier = ? WHERE state = ?', (code_verifier, state))
     return redirect(auth_url)
 
 @app.route('/callback')
 def callback():
     """Handle OAuth2 callback and exchange code for access token."""
     auth_code = request.args.get('code')
-    code_verifier = session.get('code_verifier')
-
-    if not auth_code or not code_verifier:
+    state = request.args.get('state')
+    link = None
+    if state:
+        link = get_db().execute(
+            'SELECT user_id, code_verifier FROM auth_links WHERE state = ? AND created_at >= ?',
+            (state, time.time() - AUTH_LINK_TTL)
+        ).fetchone()
+
+    if not auth_code or not link or not link[1]:
         return jsonify({'error': 'Missing authorization code or code verifier'}), 400
 
+    user_id, code_verifier = link
+    get_db().execute('DELETE FROM auth_links WHERE state = ?', (state,))
+
     token_response = get_access_token(auth_code, code_verifier)
-    print('T----------A', token_response.get('access_token'))
 
     if 'access_token' in token_response:
-        session['access_token'] = token_response['access_token']
-        Token_Response['access_token'] = token_response['access_token']
+        token_store.save(user_id, token_response)
+        session['user_id'] = user_id
+        # The user's next message is most likely about their latest designs; have them ready
+        start_prefetch(user_id, token_response['access_token'])
 
         whatsapp_url = "https://api.whatsapp.com/send?phone=14155238886&text=I%20am%20now%20authenticated%20with%20Canva!"
         button_html = f'''
@@ -148,23 +1465,39 @@ def callback():
     else:
         return jsonify({'error': 'Failed to authenticate with Canva.'}), 400
 
+sendgrid_client = None
+
+def get_sendgrid_client():
+    """Return the shared SendGrid client, importing the library and creating it on first use."""
+    global sendgrid_client
+    if sendgrid_client is None:
+        from sendgrid import SendGridAPIClient
+        client = SendGridAPIClient(api_key=sendgrid_api_key, host=SENDGRID_API_URL)
+        # python_http_client takes a single timeout for the connect and for each read
+        client.client.timeout = HTTP_READ_TIMEOUT
+        sendgrid_client = client
+    return sendgrid_client
+
 def send_email(subject, html_content, to_email):
+    """Send an email right away, returning True when SendGrid accepted it."""
     try:
+        from sendgrid.helpers.mail import Mail
         message = Mail(
             from_email=sendgrid_from_email,
             to_emails=to_email,
             subject=subject,
             html_content=html_content)
-        sg = SendGridAPIClient(api_key=sendgrid_api_key)
-        response = sg.send(message)
+        with upstream_span('sendgrid', 'send') as span:
+            response = get_sendgrid_client().send(message)
+            span.status = response.status_code
         logging.info(f"Email sent to {to_email}: {response.status_code}")
+        return 200 <= response.status_code < 300
     except Exception as e:
         logging.error(f"Failed to send email: {e}")
+        return False
 
-# Function to handle natural language input using IBM Watson model
-def handle_natural_language_input(user_input):
-    # Construct the prompt
-    prompt = f"""
+# The fixed part of the prompt is built once; each request only appends the recent turns
+CHAT_SYSTEM_PROMPT = textwrap.dedent("""
     Your name is instaCanva⚡(always put this emoji ⚡ alongside instaCanva name), a creative and productive tool designed to help users effortlessly create and manage Canva designs. Users can ask for help with tasks such as creating new designs, finding templates, customizing existing designs, managing files, or seeking account assistance.
 
     When responding to user input, tailor your reply based on the request:
@@ -173,27 +1506,66 @@ def handle_natural_language_input(user_input):
     Your Tagline: Instant ideas! Instant Designs!
     You offer several features directly within WhatsApp, including the ability to create designs, list and edit them, view projects, upload assets, and provide creative ideas for Canva projects.
 
-    If a user expresses gratitude with \"Thanks\" or a related message, it indicates that they have successfully received the service they needed.
+    If a user expresses gratitude with "Thanks" or a related message, it indicates that they have successfully received the service they needed.
     Always introduce yourself at the start of the conversation and give a brief overview of the services you offer. Feel free to use creative emojis accordingly in every response.
 
     You are built by Ronnie & Jovita from Uganda to seamlessly ship Canva into WhatsApp leveraging generative & LLM Capabilities using IBM Granite on Watsonx!
-    Input: {user_input}
-    Output:
-    """
-
+""").strip()
+
+# Generation parameters per token budget, and their cache key form, are built once too
+CHAT_PARAMETERS = {
+    kind: dict(IBM_GENERATION_PARAMETERS, max_new_tokens=budget) for kind, budget in CHAT_TOKEN_BUDGETS.items()
+}
+CHAT_PARAMETER_KEYS = {kind: json.dumps(parameters, sort_keys=True) for kind, parameters in CHAT_PARAMETERS.items()}
+
+# Greetings and thanks get a short budget, requests for ideas a long one, everything else sits in between
+CHAT_KIND_PATTERN = re.compile(r"""
+      (?P<ideas>\b(?:ideas?|brainstorm\w*|suggest\w*|inspir\w*|tips?)\b)
+    | (?P<smalltalk>^\W*(?:hi|hey|hello|thanks?|thank\s+you|ok(?:ay)?|bye|good\s+(?:morning|afternoon|evening|night))\b(?:\W+\w+){0,3}\W*$)
+""", re.IGNORECASE | re.VERBOSE)
+
+# Asking for help or what the bot can do reads the same at any point in a conversation
+HELP_PROMPT_PATTERN = re.compile(
+    r'^\W*(?:help(?:\s+me)?|menu|what\s+(?:can|do)\s+you\s+do|what\s+are\s+you|who\s+are\s+you|how\s+does\s+(?:this|it)\s+work)\W*$',
+    re.IGNORECASE
+)
+
+ChatRequest = namedtuple('ChatRequest', ['user_input', 'kind', 'history', 'key'])
+
+def chat_kind(user_input):
+    """Return the token budget name for a chat message."""
+    found = {match.lastgroup for match in CHAT_KIND_PATTERN.finditer(user_input)}
+    for kind in ('ideas', 'smalltalk'):
+        if kind in found:
+            return kind
+    return 'chat'
+
+def render_prompt(user_input, history=()):
+    """Append the recent turns and the new message to the precompiled system prompt."""
+    turns = ''.join(f"\nInput: {message}\nOutput: {reply}" for message, reply in history)
+    return f"{CHAT_SYSTEM_PROMPT}{turns}\nInput: {user_input}\nOutput:"
+
+def chat_request(user_input, sender=None):
+    """Gather everything that determines a reply: the message, its token budget and the sender's recent turns."""
+    kind = chat_kind(user_input)
+    # Greetings, thanks and help prompts read the same whatever came before, so they are generated
+    # without history and every sender shares one cached reply for each
+    history_free = kind == 'smalltalk' or HELP_PROMPT_PATTERN.match(user_input)
+    history = () if history_free else chat_history.get(sender)
+    key = (IBM_MODEL_ID, CHAT_PARAMETER_KEYS[kind], history, normalize_prompt(user_input))
+    return ChatRequest(user_input, kind, history, key)
+
+# Function to build the Watsonx generation request for a chat message
+def build_generation_request(chat):
     # Get the bearer token
     bearer_token = get_ibm_bearer_token(API_KEY)
 
     # Request body for IBM Watson model
     body = {
-        "input": prompt,
-        "parameters": {
-            "decoding_method": "greedy",
-            "max_new_tokens": 500,
-            "repetition_penalty": 1
-        },
-        "model_id": "ibm/granite-13b-chat-v2",
-        "project_id": "6ca88f8a-cc72-44d0-8f4a-8ceaf9e66c03"
+        "input": render_prompt(chat.user_input, chat.history),
+        "parameters": CHAT_PARAMETERS[chat.kind],
+        "model_id": IBM_MODEL_ID,
+        "project_id": IBM_PROJECT_ID
     }
 
     # Headers with the bearer token
@@ -202,9 +1574,105 @@ def handle_natural_language_input(user_input):
         "Content-Type": "application/json",
         "Authorization": f"Bearer {bearer_token}"
     }
+    return headers, body
+
+# Token counts and latency of each generation, per token budget
+generated_tokens = {kind: Histogram('instacanva_watsonx_generated_tokens', [10, 25, 50, 100, 150, 200, 300, 400]) for kind in CHAT_TOKEN_BUDGETS}
+input_tokens = {kind: Histogram('instacanva_watsonx_input_tokens', [300, 400, 500, 600, 800, 1000, 1500]) for kind in CHAT_TOKEN_BUDGETS}
+generation_latency = {kind: Histogram('instacanva_watsonx_generation_seconds', [0.5, 1, 2, 3, 5, 8, 13, 20, 30]) for kind in CHAT_TOKEN_BUDGETS}
+generation_stop_reasons = {}
+
+def observe_generation(kind, result, started):
+    """Record the token counts, stop reason and latency of a finished Watsonx generation."""
+    generation_latency[kind].observe(time.time() - started)
+    if result.get('generated_token_count') is not None:
+        generated_tokens[kind].observe(result['generated_token_count'])
+    if result.get('input_token_count') is not None:
+        input_tokens[kind].observe(result['input_token_count'])
+    reason = result.get('stop_reason') or 'unknown'
+    generation_stop_reasons[reason] = generation_stop_reasons.get(reason, 0) + 1
+
+@register_metrics
+def generation_metrics():
+    lines = []
+    for name, histograms in (('generated_tokens', generated_tokens), ('input_tokens', input_tokens), ('generation_seconds', generation_latency)):
+        lines.append(f"# TYPE instacanva_watsonx_{name} histogram")
+        for kind, histogram in histograms.items():
+            lines.extend(histogram.lines(f'budget="{kind}"'))
+    lines.append("# TYPE instacanva_watsonx_stop_reason_total counter")
+    for reason, count in list(generation_stop_reasons.items()):
+        lines.append(f'instacanva_watsonx_stop_reason_total{{reason="{reason}"}} {count}')
+    return lines
+
+# Replies to repeated prompts are served from memory (and SQLite across restarts)
+chat_cache = register_cache(TTLCache('chat_replies', CHAT_CACHE_TTL, CHAT_CACHE_SIZE))
+chat_flights = register_flight(SingleFlight('chat_replies'))
+
+def normalize_prompt(user_input):
+    """Casefold and collapse whitespace so trivially different messages share a cache entry."""
+    return ' '.join(user_input.casefold().split())
+
+def chat_cache_digest(key):
+    return hashlib.sha256(json.dumps(key).encode('utf-8')).hexdigest()
+
+def get_cached_reply(key):
+    """Return the cached reply for a prompt key, checking memory first and then the disk cache."""
+    reply = chat_cache.get(key)
+    if reply is None and CHAT_CACHE_PERSIST:
+        row = get_db().execute(
+            'SELECT reply, created_at FROM chat_replies WHERE cache_key = ? AND created_at >= ?',
+            (chat_cache_digest(key), time.time() - CHAT_CACHE_TTL)
+        ).fetchone()
+        if row is not None:
+            reply = row[0]
+            chat_cache.set(key, reply, ttl=row[1] + CHAT_CACHE_TTL - time.time())
+    return reply
+
+def store_reply(key, reply, latency):
+    if not reply:
+        return
+    chat_cache.set(key, reply, latency)
+    if CHAT_CACHE_PERSIST:
+        now = time.time()
+        db = get_db()
+        db.execute(
+            'INSERT OR REPLACE INTO chat_replies (cache_key, reply, created_at) VALUES (?, ?, ?)',
+            (chat_cache_digest(key), reply, now)
+        )
+        # Keep the disk cache bounded the same way as the in-memory one
+        db.execute('DELETE FROM chat_replies WHERE created_at < ?', (now - CHAT_CACHE_TTL,))
+        db.execute(
+            'DELETE FROM chat_replies WHERE cache_key NOT IN '
+            '(SELECT cache_key FROM chat_replies ORDER BY created_at DESC LIMIT ?)',
+            (CHAT_CACHE_SIZE,)
+        )
+
+# Function to handle natural language input using IBM Watson model
+def handle_natural_language_input_steps(io, user_input, sender=None):
+    """Return the chatbot reply, reusing cached or in-flight replies for the same prompt."""
+    chat = yield io.db(chat_request, user_input, sender)
+    reply = yield io.db(get_cached_reply, chat.key)
+
+    def generate_and_store():
+        started = time.time()
+        reply = yield io.generate_reply(chat)
+        yield io.db(store_reply, chat.key, reply, time.time() - started)
+        return reply
+
+    if reply is None:
+        reply = yield io.share('chat_replies', chat.key, generate_and_store)
+    yield io.db(chat_history.add, sender, user_input, reply)
+    return reply
+
+def generate_natural_language_reply(chat):
+    """Ask Watsonx for a reply and clean it up."""
+    started = time.time()
+    headers, body = build_generation_request(chat)
 
     # Send the request to the IBM model
-    response = requests.post(IBM_MODEL_URL, headers=headers, json=body)
+    with upstream_span('watsonx', 'generate') as span:
+        response = http_session.post(IBM_MODEL_URL, headers=headers, json=body, timeout=(HTTP_CONNECT_TIMEOUT, IBM_GENERATION_TIMEOUT))
+        span.status = response.status_code
 
     if response.status_code != 200:
         raise Exception(f"Non-200 response: {response.status_code}\n{response.text}")
@@ -212,8 +1680,9 @@ def handle_natural_language_input(user_input):
     # Process the response and extract the generated text
     data = response.json()
     generated_text = data['results'][0]['generated_text']
-    
-    # Step 1: Split off unwanted "Input:" part
+    observe_generation(chat.kind, data['results'][0], started)
+
+    # Step 1: Split off unwanted "Input:" part (in case the stop sequence was not honoured)
     cleaned_text = generated_text.split("Input:")[0].strip()
 
     # Step 2: Remove text within parentheses using regex
@@ -221,148 +1690,484 @@ def handle_natural_language_input(user_input):
 
     return cleaned_text
 
+class StreamCleaner:
+    """Incremental version of the cleanup in generate_natural_language_reply.
+
+    Text after the first "Input:" is dropped and "(...)" groups are removed. Anything
+    that might still turn into one of those (an unclosed parenthesis, or a trailing
+    "Inp") is held back until the next chunk decides it.
+    """
+
+    STOP = "Input:"
+
+    def __init__(self):
+        self.pending = ''
+        self.done = False
+
+    def feed(self, text):
+        if self.done:
+            return ''
+        self.pending += text
+        cut = self.pending.find(self.STOP)
+        if cut != -1:
+            self.pending = self.pending[:cut]
+            self.done = True
+        self.pending = re.sub(r'\(.*?\)', '', self.pending)
+
+        hold = len(self.pending)
+        # Like the regex, a group never spans lines, so only a parenthesis opened on the last
+        # (still growing) line can be closed later; one left open on an earlier line is kept as is
+        open_paren = self.pending.find('(', self.pending.rfind('\n') + 1)
+        if open_paren != -1:
+            hold = open_paren
+        if not self.done:
+            for size in range(len(self.STOP) - 1, 0, -1):
+                if self.pending.endswith(self.STOP[:size]):
+                    hold = min(hold, len(self.pending) - size)
+                    break
+        released, self.pending = self.pending[:hold], self.pending[hold:]
+        return released
+
+    def flush(self):
+        released, self.pending = self.pending, ''
+        return released
+
+def stream_natural_language_input(chat):
+    """Yield the cleaned reply from Watsonx's generation_stream endpoint as it is generated."""
+    started = time.time()
+    headers, body = build_generation_request(chat)
+    headers["Accept"] = "text/event-stream"
+
+    # The span covers the whole stream, from the request until the last token is read
+    with upstream_span('watsonx', 'generate_stream') as span, \
+            http_session.post(IBM_STREAM_URL, headers=headers, json=body, stream=True, timeout=(HTTP_CONNECT_TIMEOUT, IBM_GENERATION_TIMEOUT)) as response:
+        span.status = response.status_code
+        if response.status_code != 200:
+            raise Exception(f"Non-200 response: {response.status_code}\n{response.text}")
+
+        cleaner = StreamCleaner()
+        last = {}
+        for line in response.iter_lines(decode_unicode=True):
+            # Server-sent events: only the "data:" lines carry generated text
+            if not line or not line.startswith('data:'):
+                continue
+            data = json.loads(line[len('data:'):])
+            for result in data.get('results', []):
+                # Token counts are running totals; the last event has the final ones
+                last.update({name: value for name, value in result.items() if value is not None})
+                released = cleaner.feed(result.get('generated_text', ''))
+                if released:
+                    yield released
+            if cleaner.done:
+                # The model started writing the next "Input:" turn; nothing more is useful
+                break
+        observe_generation(chat.kind, last, started)
+        released = cleaner.flush()
+        if released:
+            yield released
+
+chat_first_reply_latency = Histogram('instacanva_chat_time_to_first_reply_seconds', [0.5, 1, 2, 3, 5, 8, 13, 20])
+chat_reply_latency = Histogram('instacanva_chat_reply_seconds', [1, 2, 3, 5, 8, 13, 20, 30, 60])
+SENTENCE_BOUNDARY = re.compile(r'[.!?](?=\s)|\n')
+
+def split_reply(buffer, min_chars, final=False):
+    """Split off the part of buffer that is ready to be sent, returning (ready, rest)."""
+    if final:
+        return buffer, ''
+    if len(buffer) >= WHATSAPP_MAX_CHARS:
+        cut = buffer.rfind(' ', 0, WHATSAPP_MAX_CHARS)
+        cut = cut if cut > 0 else WHATSAPP_MAX_CHARS
+        return buffer[:cut], buffer[cut:]
+    if len(buffer) < min_chars:
+        return '', buffer
+    boundaries = [m.end() for m in SENTENCE_BOUNDARY.finditer(buffer) if m.end() >= min_chars]
+    if not boundaries:
+        return '', buffer
+    return buffer[:boundaries[-1]], buffer[boundaries[-1]:]
+
+def stream_chat_reply_steps(io, user_input, to, received_at):
+    """Send a chatbot reply to the user, streaming it in sentence-aligned messages when it is not cached."""
+    state = {'sent_any': False, 'streamed': False}
+
+    def send(text):
+        yield io.send_whatsapp_message(to, text)
+        if not state['sent_any']:
+            chat_first_reply_latency.observe(time.time() - received_at)
+            state['sent_any'] = True
+
+    def stream_and_store():
+        state['streamed'] = True
+        started = time.time()
+        buffer = ''
+        reply = ''
+        stream = yield io.stream_reply(chat)
+        while True:
+            text = yield io.next_chunk(stream)
+            if text is None:
+                break
+            buffer += text
+            reply += text
+            while True:
+                ready, buffer = split_reply(buffer, CHAT_REPLY_CHUNK_CHARS if state['sent_any'] else CHAT_FIRST_REPLY_CHARS)
+                if not ready.strip():
+                    buffer = ready + buffer
+                    break
+                yield from send(ready.strip())
+        if buffer.strip():
+            yield from send(buffer.strip())
+        reply = reply.strip()
+        yield io.db(store_reply, chat.key, reply, time.time() - started)
+        return reply
+
+    try:
+        chat = yield io.db(chat_request, user_input, to)
+        reply = yield io.db(get_cached_reply, chat.key)
+        if reply is None:
+            # Identical prompts in flight share one generation; only its leader streams
+            reply = yield io.share('chat_replies', chat.key, stream_and_store)
+        yield io.db(chat_history.add, to, user_input, reply)
+        if not state['streamed']:
+            while reply:
+                ready, reply = split_reply(reply, WHATSAPP_MAX_CHARS)
+                if not ready:
+                    ready, reply = reply, ''
+                yield from send(ready.strip())
+    except Exception as e:
+        logging.error(f"Failed to stream chatbot reply: {e}")
+        if not state['sent_any']:
+            try:
+                yield io.send_whatsapp_message(to, "Sorry, I couldn't come up with a reply just now. Please try again.")
+            except Exception as e:
+                logging.error(f"Failed to send the chatbot fallback reply: {e}")
+    chat_reply_latency.observe(time.time() - received_at)
+
+@traced('chat_reply')
+def stream_chat_reply(user_input, to, received_at):
+    run_steps(stream_chat_reply_steps(blocking_io, user_input, to, received_at))
+
+@register_metrics
+def chat_metrics():
+    lines = ["# TYPE instacanva_chat_time_to_first_reply_seconds histogram"]
+    lines.extend(chat_first_reply_latency.lines())
+    lines.append("# TYPE instacanva_chat_reply_seconds histogram")
+    lines.extend(chat_reply_latency.lines())
+    return lines
+
+# Local intent router: known commands are recognised with one precompiled regex pass,
+# and only open-ended chat is handed to Watsonx
+Intent = namedtuple('Intent', ['name', 'args'])
+
+# Keywords only match as commands: whole words in the present tense, so "listen", "connection",
+# "I created a logo" and "show me how to ..." are still chat
+INTENT_PATTERN = re.compile(r"""
+      (?P<upload>\bupload(?:s|ing)?\b)
+    | (?P<connect>\bconnect(?:ing)?\b)
+    | (?P<create>\bcreat(?:e|ing)\b)
+    | (?P<search>\b(?:
+          list(?:s|ing)?
+        | (?:show|get)\s+me\b(?!\s+(?:how|what|why|where|when|some|ideas?)\b)
+        | download(?:s|ing)?
+        | export(?:s|ing)?
+      )\b)
+""", re.IGNORECASE | re.VERBOSE)
+
+# When a message contains several keywords, the earliest intent in this list wins; files always
+# win, so a captioned album ("upload these") is uploaded rather than answered with a prompt
+INTENT_PRIORITY = ['media', 'upload', 'connect', 'create', 'search']
+AUTHENTICATED_INTENTS = {'upload', 'media', 'create', 'search', 'pick'}
+
+DESIGN_TYPE_PATTERN = re.compile(r'\b(docs?|documents?|whiteboards?|presentations?|slides?|decks?)\b', re.IGNORECASE)
+DESIGN_TYPES = {
+    'doc': 'doc', 'document': 'doc',
+    'whiteboard': 'whiteboard',
+    'presentation': 'presentation', 'slide': 'presentation', 'deck': 'presentation',
+}
+TITLE_PATTERN = re.compile(r'["“](?P<quoted>[^"”]+)["”]|\b(?:called|titled|named)\s+(?P<named>.+)$', re.IGNORECASE)
+SEARCH_FILLER_PATTERN = re.compile(r'^(?:(?:my|the|a|an|all|of|for|me|designs)\b\s*)+', re.IGNORECASE)
+
+def classify_message(message, has_media=False):
+    """Return the Intent for an incoming message, extracting its arguments."""
+    found = {match.lastgroup for match in INTENT_PATTERN.finditer(message)}
+    if has_media:
+        found.add('media')
+    for name in INTENT_PRIORITY:
+        if name not in found:
+            continue
+        if name == 'create':
+            return Intent('create', extract_create_args(message))
+        if name == 'search':
+            return Intent('search', extract_search_args(message))
+        return Intent(name, {})
+    return Intent('chat', {})
+
+def extract_create_args(message):
+    design_type = DESIGN_TYPE_PATTERN.search(message)
+    design_type = DESIGN_TYPES.get(design_type.group(1).lower().rstrip('s')) if design_type else None
+    title = TITLE_PATTERN.search(message)
+    title = (title.group('quoted') or title.group('named')).strip(' "“”') if title else None
+    return {'design_type': design_type, 'title': title}
+
+DESIGN_TYPE_CHOICES = ['doc', 'whiteboard', 'presentation']
+PICK_PATTERN = re.compile(r'^\s*\d+(?:\s*(?:,|and|&|\s)\s*\d+)*\s*$', re.IGNORECASE)
+CANCEL_PATTERN = re.compile(r'^\s*(?:cancel|stop|never\s*mind|nevermind)\s*[.!]*\s*$', re.IGNORECASE)
+
+def resume_conversation(sender, message, has_media=False):
+    """Turn a reply to an open question into an Intent, or return None to route the message normally."""
+    state = conversation_store.get(sender)
+    if state is None:
+        return None
+    if has_media:
+        # Files are never an answer; drop the flow so they are uploaded rather than lost
+        conversation_store.clear(sender)
+        return None
+    if CANCEL_PATTERN.match(message):
+        conversation_store.clear(sender)
+        return Intent('cancel', {})
+
+    step = state.get('step')
+    if step == 'design_type':
+        choice = message.strip()
+        if choice.isdigit() and 1 <= int(choice) <= len(DESIGN_TYPE_CHOICES):
+            design_type = DESIGN_TYPE_CHOICES[int(choice) - 1]
+        else:
+            match = DESIGN_TYPE_PATTERN.search(message)
+            design_type = DESIGN_TYPES.get(match.group(1).lower().rstrip('s')) if match else None
+        if design_type:
+            return Intent('create', {'design_type': design_type, 'title': state.get('title')})
+    elif step == 'title':
+        title = message.strip().strip('"“”')
+        # A command ("list my designs") starts over, unless it is quoted as the title
+        quoted = message.strip().startswith(('"', '“'))
+        if title and (quoted or not INTENT_PATTERN.search(message)):
+            return Intent('create', {'design_type': state.get('design_type'), 'title': title})
+    elif step == 'pick':
+        designs = state.get('designs', [])
+        if message.strip().lower() in ('all', 'everything', 'all of them'):
+            return Intent('pick', {'designs': designs})
+        if PICK_PATTERN.match(message):
+            picked = [int(number) for number in re.findall(r'\d+', message)]
+            selected = [designs[number - 1] for number in dict.fromkeys(picked) if 1 <= number <= len(designs)]
+            if selected:
+                return Intent('pick', {'designs': selected})
+
+    # Not an answer to our question: drop the flow and treat the message as a new request
+    conversation_store.clear(sender)
+    return None
+
+def extract_search_args(message):
+    query = INTENT_PATTERN.sub(' ', message).replace('"', ' ').replace('“', ' ').replace('”', ' ')
+    query = SEARCH_FILLER_PATTERN.sub('', ' '.join(query.split()))
+    return {'query': query.lower()}
+
+intent_latency = {}
+
+def observe_intent_latency(intent_name, seconds):
+    histogram = intent_latency.get(intent_name)
+    if histogram is None:
+        histogram = intent_latency.setdefault(
+            intent_name, Histogram('instacanva_whatsapp_request_seconds', [0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 15])
+        )
+    histogram.observe(seconds)
+
+@register_metrics
+def intent_metrics():
+    lines = ["# TYPE instacanva_whatsapp_request_seconds histogram"]
+    for intent_name, histogram in list(intent_latency.items()):
+        lines.extend(histogram.lines(f'intent="{intent_name}"'))
+    return lines
+
 @app.route('/whatsapp', methods=['POST'])
 def whatsapp():
     """Handle incoming WhatsApp messages."""
-    incoming_msg = request.values.get('Body', '').lower()
-    media_url = request.values.get('MediaUrl0', '')
+    received_at = time.time()
+    start_notification_dispatcher()
+    raw_msg = request.values.get('Body', '')
+    media_urls = incoming_media_urls(request.values)
+    sender = request.values.get('From') or RECIPIENT_NO
+    return run_steps(whatsapp_steps(blocking_io, raw_msg, media_urls, sender, received_at, g.trace))
+
+def whatsapp_steps(io, raw_msg, media_urls, sender, received_at, trace):
+    """Route an incoming WhatsApp message and return the TwiML reply."""
+    # The bucket is checked first, so a sender over their limit costs one SQLite write and nothing more
+    if not (yield io.db(rate_limiter.allow, sender)):
+        trace.attributes['intent'] = 'rate_limited'
+        observe_intent_latency('rate_limited', time.time() - received_at)
+        return busy_reply(RATE_LIMITED_REPLY)
+    intent = (yield io.db(resume_conversation, sender, raw_msg, bool(media_urls))) or classify_message(raw_msg, bool(media_urls))
+    trace.attributes['intent'] = intent.name
+    try:
+        return (yield from handle_intent_steps(io, intent, raw_msg.lower(), media_urls, sender, received_at))
+    finally:
+        observe_intent_latency(intent.name, time.time() - received_at)
+
+def incoming_media_urls(values):
+    """Return the URLs of every file attached to a Twilio webhook (MediaUrl0 to MediaUrl{NumMedia-1})."""
+    try:
+        count = int(values.get('NumMedia') or 0)
+    except ValueError:
+        count = 0
+    urls = (values.get(f'MediaUrl{index}') for index in range(max(count, 1)))
+    return [url for url in urls if url][:TWILIO_MAX_INCOMING_MEDIA]
+
+def handle_intent_steps(io, intent, incoming_msg, media_urls, sender, received_at):
+    """Carry out a classified WhatsApp message and return the TwiML reply."""
+    access_token = yield io.get_access_token(sender)
 
     resp = MessagingResponse()
     msg = resp.message()
 
-    # This will store the title temporarily
-    user_data = {}
-    list_data = {}
-
-    # Check if the user wants to upload
-    if 'upload' in incoming_msg:
-        if 'access_token' not in Token_Response:
-            msg.body("Please authenticate first by visiting: https://instacanva.onrender.com")
-        else:
-            msg.body("Go on to upload your asset now!")
-    elif media_url and 'access_token' in Token_Response:
-        try:
-            # Fetch the media content
-            file_data = requests.get(media_url).content
-            upload_success = upload_asset_to_canva(file_data, Token_Response['access_token'])
-
-            if upload_success:
-                msg.body("Your asset has been successfully uploaded to your Canva account💥.")
-
-                # Send the alert to Design Team Lead or Admin via email
-                recipient_email = RECIPIENT_MAIL
-                subject = 'New Upload to Canva via instaCanva 🎉'
-                html_content = '''
-                An asset has been successfully uploaded by one of your team members and may require some attention or review 🤩✨!<br>
-                Thanks & Regards!<br>
-                <strong>instaCanva⚡</strong>
-                '''
-                send_email(subject, html_content, recipient_email)
-            else:
-                msg.body("There was an error uploading your asset. Please try again.")
-        except Exception as e:
-            print(f"Error processing media: {e}")
-            msg.body("There was an error processing your media. Please try again.")
-    elif 'connect' in incoming_msg:
-        if 'access_token' not in Token_Response:
-            msg.body("Please authenticate first by visiting: https://instacanva.onrender.com")
+    if intent.name in AUTHENTICATED_INTENTS and not access_token:
+        auth_link = yield io.db(create_auth_link, sender)
+        msg.body(f"Please authenticate first by visiting: {auth_link}")
+    elif intent.name == 'upload':
+        msg.body("Go on to upload your asset now!")
+    elif intent.name == 'media':
+        start_upload(msg, media_urls, access_token, sender, submit=io.submit_upload_batch)
+    elif intent.name == 'connect':
+        if not access_token:
+            auth_link = yield io.db(create_auth_link, sender)
+            msg.body(f"Please authenticate first by visiting: {auth_link}")
         else:
             msg.body("Great Connecting! Let the magic begin🚀")
             msg.body("What do you want to do?")
-    elif 'create' in incoming_msg and 'access_token' in Token_Response:
-        if incoming_msg:    # Ask for the title of the creation
-            # msg.body("Sure, give us a title for your creation")
-            user_data['expected_action'] = 'get_title'
-            user_data['design_type'] = 'doc'  # Store the design type for later use
-        if user_data.get('expected_action') == 'get_title':
-            # Capture the title from the user response
-            title = incoming_msg
+    elif intent.name == 'cancel':
+        msg.body("Okay, cancelled 👍 What would you like to do next?")
+    elif intent.name == 'create':
+        if not intent.args.get('design_type'):
+            yield io.db(conversation_store.set, sender, {'step': 'design_type', 'title': intent.args.get('title')})
+            options = '\n'.join(f"{number}. {name.title()}" for number, name in enumerate(DESIGN_TYPE_CHOICES, 1))
+            msg.body(f"What would you like to create?\n{options}")
+        elif not intent.args.get('title'):
+            yield io.db(conversation_store.set, sender, {'step': 'title', 'design_type': intent.args['design_type']})
+            msg.body("Sure, give us a title for your creation")
+        else:
+            yield io.db(conversation_store.clear, sender)
             data = {
                 "design_type": {
                     "type": "preset",  # Can be "preset" or "custom"
-                    "name": user_data.get('design_type')  # Use the stored design type
+                    "name": intent.args['design_type']
                 },
-                "title": title  # Use the title provided by the user
+                "title": intent.args['title']  # Use the title provided by the user
             }
-            created = create_design(data, Token_Response['access_token'])
+            created = yield io.create_design(data, access_token)
             if created:
                 msg.body("Your creation has been successfully created 💥.")
             else:
                 msg.body("There was an error creating your document. Please try again.")
-            # Reset the user data after creation
-            user_data.clear()
-    elif 'list' in incoming_msg or 'show me' in incoming_msg or 'get me' in incoming_msg or 'download' in incoming_msg or 'export' in incoming_msg and 'access_token' in Token_Response:
-        # response_message = "Here are the top 5 designs matching your search:"
-        # msg.body(response_message)
-        # msg.body("Please provide a search term to filter your designs.")
-        incoming_msg = incoming_msg.replace('list', '').replace('show me', '').replace('get me', '').replace('download', '').replace('export', '').strip()
-        list_data['expected_action'] = 'search_designs'
-
-        listed_designs = list_designs(Token_Response['access_token'], incoming_msg)
-        # search = incoming_msg
-        if listed_designs.status_code == 200:
-            designs_data = listed_designs.json()
-            designs = designs_data.get("items", [])
-
-            filtered_designs = [design for design in designs]
-
-            # Select the top 5 results - LET'S FIRST GET ONE FOR NOW
-            top_5_designs = filtered_designs[:1]
-            if top_5_designs:
-                for design in top_5_designs:
-                    title = design.get('title', 'No Title')
-                    design_id = design.get('id', 'No ID')
-                    thumbnail_url = design.get('thumbnail', {}).get('url', '')
-
-                    # Send the thumbnail as an image with a caption
-                    if thumbnail_url:
-                        # msg.media(thumbnail_url)
-                        # caption = f"""Title: {title} with ID: {design_id} """
-                        # msg.body(caption)
-                        # print('DESIGNS:', title, design_id, thumbnail_url)
-                        create_export = create_export_job(design_id, "pdf", Token_Response['access_token'])
-                        if create_export.status_code == 200:
-                            export_job = create_export.json().get("job", {})
-                            export_job_id = export_job.get('id')
-                            print(f"Export Job ID: {export_job_id}")
-
-                            url = poll_export_status(export_job_id, Token_Response['access_token'])
-                            if url:  # If the export job is successful and a URL is returned
-                                file_name = "instaCanvaExport.pdf"  # Define the name of the file to save
-                                print(url[0])
-
-                                message = client.messages.create(
-                                    body="Here's what you requested!",
-                                    media_url=url,
-                                    to=f'whatsapp:{RECIPIENT_NO}',
-                                    from_=f'whatsapp:{twilio_phone_number}',
-                                )
-                                print("MB", message.body)
-                            else:
-                                msg.body("There was an error exporting your design. Please try again.")
-                        else:
-                            print(f"Failed to create export job: {create_export.status_code}")
-                    else:
-                        # If no thumbnail is available, send the details without the image
-                        fallback_message = f'''Title: {title} with ID: {design_id} Thumbnail: No Thumbnail Available'''
-                        msg.body(fallback_message)
-            else:
-                msg.body("No designs matched your search term. Please try again with a different term.")
-        else:
-            msg.body("There was an error retrieving your designs. Please try again.")
-
-        # Reset the user data after the search
-        list_data.clear()
+    elif intent.name == 'search':
+        try:
+            # Only fetch as many result pages as it takes to find the top designs
+            top_designs = yield from top_designs_steps(io, access_token, intent.args['query'], EXPORT_TOP_N)
+        except Exception as e:
+            logging.error(f"Failed to search designs: {e}")
+            top_designs = None
 
+        if top_designs is None:
+            msg.body("There was an error retrieving your designs. Please try again.")
+        elif not top_designs:
+            msg.body("No designs matched your search term. Please try again with a different term.")
+        elif len(top_designs) == 1:
+            yield from start_export_steps(io, msg, top_designs, access_token, sender)
+        else:
+            # Remember the results so the user's pick needs no new Canva query
+            designs = [
+                {'id': design.get('id'), 'title': design.get('title', 'No Title'), 'thumbnail': design.get('thumbnail', {}).get('url', '')}
+                for design in top_designs
+            ]
+            yield io.db(conversation_store.set, sender, {'step': 'pick', 'designs': designs})
+            options = '\n'.join(f"{number}. {design['title']}" for number, design in enumerate(designs, 1))
+            msg.body(f"I found these designs:\n{options}\nReply with a number (or several, like 1 3), or 'all'.")
+            # Show the thumbnails too, but only when they line up with every numbered option. WhatsApp
+            # delivers one media file per message, so each follows as its own numbered message.
+            thumbnails = yield io.db(thumbnail_cache.urls, sender, [design['id'] for design in designs])
+            if all(thumbnails):
+                for number, (design, url) in enumerate(zip(designs, thumbnails), 1):
+                    yield io.db(notify_whatsapp, sender, f"{number}. {design['title']}", [url])
+        if top_designs:
+            yield io.db(refresh_thumbnails, sender, top_designs)
+    elif intent.name == 'pick':
+        designs = [
+            {'id': design['id'], 'title': design['title'], 'thumbnail': {'url': design['thumbnail']}}
+            for design in intent.args['designs']
+        ]
+        # Keep the choices around when we are too busy, so the user can simply send their pick again
+        if (yield from start_export_steps(io, msg, designs, access_token, sender)):
+            yield io.db(conversation_store.clear, sender)
+    elif not watsonx_limit.acquire():
+        msg.body(BUSY_REPLY)
+    elif CHAT_STREAMING:
+        # Acknowledge Twilio right away; the reply is streamed back over the REST API
+        io.start_chat_reply(incoming_msg, sender, received_at)
+        return str(MessagingResponse())
     else:
-        chat_bot = handle_natural_language_input(incoming_msg)
+        try:
+            chat_bot = yield from handle_natural_language_input_steps(io, incoming_msg, sender)
+        finally:
+            watsonx_limit.release()
         msg.body(chat_bot)
 
     return str(resp)
 
+def top_designs_steps(io, access_token, search, limit):
+    """Return the first limit designs matching search, fetching only the result pages that takes."""
+    designs = []
+    continuation = None
+    while len(designs) < limit:
+        response = yield io.list_designs(access_token, search, continuation=continuation)
+        if isinstance(response, int):
+            raise Exception(f"Failed to list designs: {response}")
+        designs_data = response.json()
+        designs.extend(designs_data.get("items", [])[:limit - len(designs)])
+        continuation = designs_data.get("continuation")
+        if not continuation:
+            break
+    return designs
+
+def start_export_steps(io, msg, designs, access_token, sender):
+    """Queue the export of the chosen designs and tell the user it is on its way.
+
+    Returns False if the export was turned away because too many are already running.
+    """
+    export_ids = []
+    export_titles = []
+    # WhatsApp delivers one media file per message: the first thumbnail rides on the reply
+    # and any others are sent as messages of their own once the export is queued
+    reply_thumbnail = None
+    extra_thumbnails = []
+    cached_thumbnails = yield io.db(thumbnail_cache.urls, sender, [design.get('id', 'No ID') for design in designs])
+    for design, cached_thumbnail in zip(designs, cached_thumbnails):
+        title = design.get('title', 'No Title')
+        design_id = design.get('id', 'No ID')
+        thumbnail_url = design.get('thumbnail', {}).get('url', '')
+
+        if thumbnail_url:
+            # Show the cached thumbnail right away; the export itself follows in the background
+            if cached_thumbnail and not reply_thumbnail:
+                reply_thumbnail = cached_thumbnail
+                msg.media(cached_thumbnail)
+            elif cached_thumbnail:
+                extra_thumbnails.append((title, cached_thumbnail))
+            export_ids.append(design_id)
+            export_titles.append(title)
+        else:
+            # If no thumbnail is available, send the details without the image
+            fallback_message = f'''Title: {title} with ID: {design_id} Thumbnail: No Thumbnail Available'''
+            msg.body(fallback_message)
+
+    if export_ids:
+        # Export in the background so the webhook can answer Twilio right away
+        if not io.enqueue_export(export_ids, "pdf", access_token, sender, export_titles):
+            msg.body(BUSY_REPLY)
+            return False
+        titles = ', '.join(f'"{title}"' for title in export_titles)
+        msg.body(f"Exporting {titles} for you ⏳ I'll send it here as soon as it's ready!")
+        for title, url in extra_thumbnails:
+            yield io.db(notify_whatsapp, sender, title, [url])
+    return True
+
 def get_access_token(auth_code, code_verifier):
     """Exchange the authorization code for an access token."""
-    token_url = "https://api.canva.com/rest/v1/oauth/token"
+    token_url = CANVA_TOKEN_URL
 
     credentials = base64.b64encode(f'{CLIENT_ID}:{CLIENT_SECRET}'.encode()).decode()
 
@@ -378,12 +2183,33 @@ def get_access_token(auth_code, code_verifier):
         "code_verifier": code_verifier
     }
 
-    response = requests.post(token_url, headers=headers, data=data)
+    with upstream_span('canva', 'oauth_token') as span:
+        response = http_session.post(token_url, headers=headers, data=data)
+        span.status = response.status_code
+    return response.json()
+
+def refresh_access_token(refresh_token):
+    """Exchange a refresh token for a new access token (Canva rotates the refresh token too)."""
+    credentials = base64.b64encode(f'{CLIENT_ID}:{CLIENT_SECRET}'.encode()).decode()
+
+    headers = {
+        "Authorization": f"Basic {credentials}",
+        "Content-Type": "application/x-www-form-urlencoded"
+    }
+
+    data = {
+        "grant_type": "refresh_token",
+        "refresh_token": refresh_token
+    }
+
+    with upstream_span('canva', 'oauth_refresh') as span:
+        response = http_session.post(CANVA_TOKEN_URL, headers=headers, data=data)
+        span.status = response.status_code
     return response.json()
 
-def upload_asset_to_canva(file_data, access_token):
-    """Upload an asset to Canva."""
-    upload_url = "https://api.canva.com/rest/v1/asset-uploads"
+def upload_asset_to_canva(media, access_token):
+    """Stream a spooled file to Canva as a new asset, returning the response with the upload job."""
+    upload_url = f"{CANVA_API_URL}/asset-uploads"
 
     headers = {
         "Authorization": f"Bearer {access_token}",
@@ -391,60 +2217,462 @@ def upload_asset_to_canva(file_data, access_token):
         "Asset-Upload-Metadata": json.dumps({ "name_base64": "TXkgQXdlc29tZSBVcGxvYWQg8J+agA==" })
     }
 
-    response = requests.post(upload_url, headers=headers, data=file_data)
-    print(response.status_code)
+    media.rewind()
+    with upstream_span('canva', 'asset_upload') as span:
+        response = upload_http_session.post(upload_url, headers=headers, data=media)
+        span.status = response.status_code
+    return response
+
+def upload_asset_steps(io, media, access_token):
+    """Upload an asset to Canva and wait for the upload job to finish.
+
+    Returns the created asset on success, otherwise None.
+    """
+    response = yield io.upload_asset(media, access_token)
+    if response.status_code != 200:
+        logging.error(f"Failed to upload asset: {response.status_code}")
+        return None
+
+    upload_job = response.json().get("job", {})
+    if upload_job.get("status") == "success":
+        asset = upload_job.get("asset", {})
+    else:
+        asset = yield from poll_asset_upload_status_steps(io, upload_job.get("id"), access_token)
+    if asset is not None:
+        invalidate_design_caches(access_token)
+    return asset
+
+def get_asset_upload_status(upload_job_id, access_token):
+    """Get the status of an asset upload job."""
+    upload_status_url = f"{CANVA_API_URL}/asset-uploads/{upload_job_id}"
+    headers = {
+        "Authorization": f"Bearer {access_token}"
+    }
+    with upstream_span('canva', 'asset_upload_status') as span:
+        response = http_session.get(upload_status_url, headers=headers)
+        span.status = response.status_code
+    return response
+
+def poll_asset_upload_status_steps(io, upload_job_id, access_token, timeout=ASSET_UPLOAD_TIMEOUT, initial_interval=0.5, max_interval=5, backoff=1.5):
+    """Poll an asset upload job until it completes, returning the asset or None."""
+    deadline = time.time() + timeout
+    interval = initial_interval
+    iterations = 0
+    try:
+        while True:
+            iterations += 1
+            response = yield io.get_asset_upload_status(upload_job_id, access_token)
+            if response.status_code == 200:
+                upload_job = response.json().get("job", {})
+                status = upload_job.get("status")
+                if status == "success":
+                    return upload_job.get("asset", {})
+                elif status == "failed":
+                    logging.error(f"Asset upload failed: {upload_job.get('error')}")
+                    return None
+            else:
+                logging.warning(f"Failed to get asset upload status: {response.status_code}")
 
-    return response.status_code == 200
+            if time.time() + interval > deadline:
+                break
+            yield io.sleep(interval)
+            interval = min(interval * backoff, max_interval)
+        logging.error("Timed out waiting for the asset upload to complete.")
+        return None
+    finally:
+        poll_iterations['asset_upload'].observe(iterations)
+
+def get_asset(asset_id, access_token):
+    """Get an asset's metadata from Canva."""
+    headers = {
+        "Authorization": f"Bearer {access_token}"
+    }
+    with upstream_span('canva', 'get_asset') as span:
+        response = http_session.get(f"{CANVA_API_URL}/assets/{asset_id}", headers=headers)
+        span.status = response.status_code
+    return response
+
+def find_uploaded_asset_steps(io, user_id, digest, access_token):
+    """Return the asset this sender already uploaded with the same content, or None."""
+    asset_id = yield io.db(asset_index.get, user_id, digest)
+    if asset_id is None:
+        return None
+    response = yield io.get_asset(asset_id, access_token)
+    if response.status_code == 200:
+        return response.json().get('asset', {'id': asset_id})
+    if response.status_code == 404:
+        # Deleted in Canva since, so it has to be uploaded again
+        yield io.db(asset_index.forget, user_id, digest)
+    return None
+
+def download_media(media_url):
+    """Download a file from Twilio into a SpooledMedia, which hashes it as the chunks arrive."""
+    media = SpooledMedia()
+    try:
+        with upstream_span('twilio', 'media') as span:
+            media_response = http_session.get(media_url, stream=True)
+            span.status = media_response.status_code
+        with media_response:
+            media_response.raise_for_status()
+            for chunk in MediaStream(media_response):
+                media.write(chunk)
+    except BaseException:
+        media.close()
+        raise
+    return media
+
+# Identical files uploaded by the same sender at the same time share one Canva upload
+asset_upload_flights = register_flight(SingleFlight('asset_uploads'))
+
+def ingest_media_steps(io, media_url, access_token, sender):
+    """Copy one file from Twilio into Canva, returning 'uploaded', 'duplicate', 'too_large' or 'failed'.
+
+    The download is hashed while it is spooled, and a file the sender already uploaded
+    resolves to the existing asset without being sent to Canva again.
+    """
+    try:
+        with (yield io.download_media(media_url)) as media:
+            digest = media.digest()
+
+            shared = True
+
+            def upload():
+                nonlocal shared
+                shared = False
+                if (yield from find_uploaded_asset_steps(io, sender, digest, access_token)) is not None:
+                    return 'duplicate'
+                asset = yield from upload_asset_steps(io, media, access_token)
+                if asset is None:
+                    return 'failed'
+                if asset.get('id'):
+                    yield io.db(asset_index.add, sender, digest, asset['id'])
+                return 'uploaded'
+
+            result = yield io.share('asset_uploads', (sender, digest), upload)
+            # The same file twice in one album: only the first copy was actually uploaded
+            return 'duplicate' if shared and result == 'uploaded' else result
+    except MediaTooLarge as e:
+        logging.info(f"Rejected media: {e}")
+        return 'too_large'
+    except Exception as e:
+        logging.error(f"Error processing media: {e}")
+        return 'failed'
+
+# Album uploads: every file of a message is ingested on a shared pool, a few at a time per
+# sender, and the batch is confirmed with one WhatsApp reply and one admin email
+upload_stats = {'batches': 0, 'rejected_batches': 0, 'uploaded_files': 0, 'duplicate_files': 0, 'too_large_files': 0, 'failed_files': 0}
+upload_batch_latency = Histogram('instacanva_upload_batch_seconds', [1, 2.5, 5, 10, 20, 30, 60, 120, 300])
+
+class UploadScheduler:
+    """Runs upload tasks on a shared pool, at most per_user at once for each sender.
+
+    A sender's remaining tasks wait in their own line instead of occupying pool threads,
+    so one large album cannot starve everybody else's uploads.
+    """
+
+    def __init__(self, pool_name, workers, per_user, max_queued):
+        self.pool_name = pool_name
+        self.workers = workers
+        self.per_user = per_user
+        self.max_queued = max_queued
+        self.lock = threading.Lock()
+        self.running = {}
+        self.waiting = {}
+
+    def submit(self, sender, tasks):
+        """Queue the sender's tasks, or return False if that would exceed their limit."""
+        with self.lock:
+            if self.running.get(sender, 0) + len(self.waiting.get(sender, ())) + len(tasks) > self.max_queued:
+                return False
+            self.waiting.setdefault(sender, []).extend(tasks)
+            ready = self._take(sender)
+        for task in ready:
+            self._start(sender, task)
+        return True
+
+    def _take(self, sender):
+        waiting = self.waiting.get(sender, [])
+        ready = []
+        while waiting and self.running.get(sender, 0) < self.per_user:
+            ready.append(waiting.pop(0))
+            self.running[sender] = self.running.get(sender, 0) + 1
+        if not waiting:
+            self.waiting.pop(sender, None)
+        return ready
+
+    def _start(self, sender, task):
+        get_executor(self.pool_name, self.workers).submit(contextvars.copy_context().run, self._run, sender, task)
+
+    def _run(self, sender, task):
+        try:
+            task()
+        except Exception as e:
+            logging.error(f"Upload task failed: {e}")
+        finally:
+            with self.lock:
+                self.running[sender] -= 1
+                if not self.running[sender]:
+                    del self.running[sender]
+                ready = self._take(sender)
+            for next_task in ready:
+                self._start(sender, next_task)
+
+upload_scheduler = UploadScheduler('upload', UPLOAD_WORKERS, UPLOAD_PER_USER_CONCURRENCY, UPLOAD_MAX_QUEUED_PER_USER)
+
+class UploadBatch:
+    """The files of one WhatsApp message; whichever upload finishes last reports the batch."""
+
+    def __init__(self, sender, media_urls, access_token):
+        self.sender = sender
+        self.media_urls = media_urls
+        self.access_token = access_token
+        self.results = [None] * len(media_urls)
+        self.remaining = len(media_urls)
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def upload(self, index):
+        with traced('media_upload', file=index):
+            result = run_steps(ingest_media_steps(blocking_io, self.media_urls[index], self.access_token, self.sender))
+        with self.lock:
+            self.results[index] = result
+            self.remaining -= 1
+            done = self.remaining == 0
+        if done:
+            deliver_upload_batch(self.sender, self.results, self.started)
+
+def submit_upload_batch(sender, media_urls, access_token):
+    """Upload every file of a message in the background, returning False if the sender is over their limit."""
+    batch = UploadBatch(sender, media_urls, access_token)
+    tasks = [functools.partial(batch.upload, index) for index in range(len(media_urls))]
+    return upload_scheduler.submit(sender, tasks)
+
+def start_upload(msg, media_urls, access_token, sender, submit=None):
+    """Start uploading the files of a message and tell the user they are on their way."""
+    submit = submit or submit_upload_batch
+    if not submit(sender, media_urls, access_token):
+        upload_stats['rejected_batches'] += 1
+        msg.body("You already have a lot of uploads in progress. Please wait for them to finish before sending more.")
+        return
+    upload_stats['batches'] += 1
+    if len(media_urls) == 1:
+        msg.body("Uploading your file to Canva ⏳ I'll let you know as soon as it's done!")
+    else:
+        msg.body(f"Uploading your {len(media_urls)} files to Canva ⏳ I'll let you know as soon as they're done!")
+
+def deliver_upload_batch(to, results, started):
+    """Confirm a finished batch to the user in one message and alert the admin in one email."""
+    uploaded = results.count('uploaded')
+    duplicates = results.count('duplicate')
+    too_large = results.count('too_large')
+    failed = len(results) - uploaded - duplicates - too_large
+    upload_stats['uploaded_files'] += uploaded
+    upload_stats['duplicate_files'] += duplicates
+    upload_stats['too_large_files'] += too_large
+    upload_stats['failed_files'] += failed
+
+    if len(results) == 1:
+        body = {
+            'uploaded': "Your asset has been successfully uploaded to your Canva account💥.",
+            'duplicate': "You've uploaded this file before, so it's already in your Canva account💥.",
+            'too_large': f"That file is too large to upload. The limit is {MEDIA_MAX_BYTES // (1024 * 1024)} MB.",
+        }.get(results[0], "There was an error uploading your asset. Please try again.")
+    else:
+        if uploaded + duplicates == len(results):
+            body = f"All {len(results)} of your files are in your Canva account💥."
+        else:
+            body = f"{uploaded + duplicates} of your {len(results)} files are in your Canva account."
+        if duplicates:
+            body += f" {duplicates} {'was' if duplicates == 1 else 'were'} uploaded before, so {'it was' if duplicates == 1 else 'they were'} not sent again."
+        if too_large:
+            body += f" {too_large} {'was' if too_large == 1 else 'were'} over the {MEDIA_MAX_BYTES // (1024 * 1024)} MB limit."
+        if failed:
+            body += f" {failed} could not be uploaded, please try sending {'it' if failed == 1 else 'them'} again."
+    notify_whatsapp(to, body)
+
+    if uploaded:
+        # Send the alert to Design Team Lead or Admin via email
+        assets = 'An asset has' if uploaded == 1 else f'{uploaded} assets have'
+        html_content = f'''
+        {assets} been successfully uploaded by one of your team members and may require some attention or review 🤩✨!<br>
+        Thanks & Regards!<br>
+        <strong>instaCanva⚡</strong>
+        '''
+        # Bursts of batches are still combined into a single digest email
+        notify_email('New Upload to Canva via instaCanva 🎉', html_content, RECIPIENT_MAIL, digest_key='upload_alert')
+    upload_batch_latency.observe(time.time() - started)
+
+@register_metrics
+def upload_metrics():
+    with upload_scheduler.lock:
+        running = sum(upload_scheduler.running.values())
+        waiting = sum(len(tasks) for tasks in upload_scheduler.waiting.values())
+    lines = [
+        "# TYPE instacanva_uploads_running gauge",
+        f"instacanva_uploads_running {running}",
+        "# TYPE instacanva_uploads_waiting gauge",
+        f"instacanva_uploads_waiting {waiting}",
+        "# TYPE instacanva_upload_batch_seconds histogram",
+    ]
+    lines.extend(upload_batch_latency.lines())
+    for name, value in upload_stats.items():
+        lines.append(f"# TYPE instacanva_upload_{name}_total counter")
+        lines.append(f"instacanva_upload_{name}_total {value}")
+    return lines
 
 def create_design(data, access_token):
     """Create a design in Canva."""
-    create_design_url = "https://api.canva.com/rest/v1/designs"
+    create_design_url = f"{CANVA_API_URL}/designs"
     headers = {
         "Authorization": f"Bearer {access_token}",
         "Content-Type": "application/json"
     }
-    response = requests.post(create_design_url, headers=headers, json=data)
+    with upstream_span('canva', 'create_design') as span:
+        response = http_session.post(create_design_url, headers=headers, json=data)
+        span.status = response.status_code
     if response.status_code == 200:
         design_data = response.json()
+        invalidate_design_caches(access_token)
         return response.status_code == 200
     else:
-        print(f"Failed to create design: {response.json()}")
+        logging.error(f"Failed to create design: {response.status_code} {response.text}")
         return None
 
-def list_designs(access_token,search):
-    """List all designs."""
-    list_designs_url = "https://api.canva.com/rest/v1/designs"
+# Users repeat the same searches back-to-back, so listings and metadata are cached per access token
+designs_cache = register_cache(TTLCache('designs', DESIGN_CACHE_TTL, DESIGN_CACHE_SIZE))
+design_metadata_cache = register_cache(TTLCache('design_metadata', DESIGN_CACHE_TTL, DESIGN_CACHE_SIZE))
+
+def invalidate_design_caches(access_token):
+    """Forget cached listings and metadata after the user changes their Canva content."""
+    designs_cache.invalidate(access_token)
+    design_metadata_cache.invalidate(access_token)
+
+def list_designs(access_token, search, ownership="any", sort_by="modified_descending", continuation=None):
+    """List one page of designs."""
+    cache_key = (access_token, search, ownership, sort_by, continuation)
+    cached = designs_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    list_designs_url = f"{CANVA_API_URL}/designs"
     query_params = {
         "query": search,  # Optional: Add search term here if needed
-        "ownership": "any",  # Can be "owned", "shared", or "any"
-        "sort_by": "modified_descending"  # Can be "relevance", "modified_descending", "title_ascending", etc.
+        "ownership": ownership,  # Can be "owned", "shared", or "any"
+        "sort_by": sort_by  # Can be "relevance", "modified_descending", "title_ascending", etc.
     }
+    if continuation:
+        query_params["continuation"] = continuation
     headers = {
         "Authorization": f"Bearer {access_token}"
     }
-    response = requests.get(list_designs_url, headers=headers, params=query_params)
+    started = time.time()
+    with upstream_span('canva', 'list_designs') as span:
+        response = http_session.get(list_designs_url, headers=headers, params=query_params)
+        span.status = response.status_code
     if response.status_code == 200:
+        designs_cache.set(cache_key, response, time.time() - started)
         return response
     else:
-        print(f"Failed to list designs: {response.json()}")
+        logging.error(f"Failed to list designs: {response.status_code} {response.text}")
         return response.status_code
 
-def get_design_metadata(design_id, access_token):
+def iter_designs(access_token, search, ownership="any", sort_by="modified_descending"):
+    """Lazily yield designs across all result pages, fetching the next page only when needed."""
+    continuation = None
+    while True:
+        response = list_designs(access_token, search, ownership, sort_by, continuation)
+        if isinstance(response, int):
+            raise Exception(f"Failed to list designs: {response}")
+        designs_data = response.json()
+        yield from designs_data.get("items", [])
+        continuation = designs_data.get("continuation")
+        if not continuation:
+            return
+
+def get_design_metadata(design_id, access_token, use_cache=True):
     """Get metadata for a specific design."""
-    get_design_url = f"https://api.canva.com/rest/v1/designs/{design_id}"
+    cache_key = (access_token, design_id)
+    cached = design_metadata_cache.get(cache_key) if use_cache else None
+    if cached is not None:
+        return cached
+
+    get_design_url = f"{CANVA_API_URL}/designs/{design_id}"
     headers = {
         "Authorization": f"Bearer {access_token}"
     }
-    response = requests.get(get_design_url, headers=headers)
+    started = time.time()
+    with upstream_span('canva', 'get_design') as span:
+        response = http_session.get(get_design_url, headers=headers)
+        span.status = response.status_code
     if response.status_code == 200:
-        return response.json()
+        metadata = response.json()
+        design_metadata_cache.set(cache_key, metadata, time.time() - started)
+        return metadata
     else:
-        print(f"Failed to get design metadata: {response.json()}")
+        logging.error(f"Failed to get design metadata: {response.status_code} {response.text}")
         return None
 
+prefetch_stats = {'runs': 0, 'designs': 0, 'thumbnails': 0, 'failed': 0}
+
+def start_prefetch(user_id, access_token):
+    """Warm the caches for a user in the background."""
+    if PREFETCH_DESIGNS > 0:
+        get_executor('prefetch', PREFETCH_WORKERS).submit(prefetch_designs, user_id, access_token)
+
+@traced('prefetch')
+def prefetch_designs(user_id, access_token):
+    """Cache the thumbnails of the user's most recently modified designs.
+
+    The listing is requested exactly as a plain "show me" search does, so a search within
+    DESIGN_CACHE_TTL seconds is answered from the listing cache. Design metadata is not
+    prefetched: exports always ask Canva for the current revision.
+    """
+    prefetch_stats['runs'] += 1
+    try:
+        designs = list(itertools.islice(iter_designs(access_token, '', sort_by='modified_descending'), PREFETCH_DESIGNS))
+        prefetch_stats['designs'] += len(designs)
+        prefetch_thumbnails(user_id, designs)
+    except Exception as e:
+        prefetch_stats['failed'] += 1
+        logging.error(f"Failed to prefetch designs: {e}")
+
+def stale_thumbnails(user_id, designs):
+    """Return the designs whose thumbnail is missing from the cache or older than the design."""
+    stale = []
+    for design in designs:
+        if not design.get('thumbnail', {}).get('url'):
+            continue
+        cached_at = thumbnail_cache.updated_at(user_id, design['id'])
+        if cached_at is None or cached_at < design.get('updated_at', 0):
+            stale.append(design)
+    return stale
+
+def prefetch_thumbnails(user_id, designs):
+    """Download and cache the thumbnails of designs that do not have an up-to-date one yet."""
+    for design in stale_thumbnails(user_id, designs):
+        try:
+            with upstream_span('canva', 'thumbnail') as span:
+                response = http_session.get(design['thumbnail']['url'], stream=True, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+                span.status = response.status_code
+            with response:
+                response.raise_for_status()
+                content = b''.join(MediaStream(response, max_bytes=THUMBNAIL_MAX_BYTES))
+            content_type = response.headers.get('Content-Type', 'image/png')
+            thumbnail_cache.store(user_id, design['id'], design.get('updated_at', 0), content, content_type)
+            prefetch_stats['thumbnails'] += 1
+        except Exception as e:
+            prefetch_stats['failed'] += 1
+            logging.error(f"Failed to cache thumbnail of design {design.get('id')}: {e}")
+
+def refresh_thumbnails(user_id, designs):
+    """Cache missing or outdated thumbnails of search results in the background, for next time."""
+    stale = stale_thumbnails(user_id, designs)
+    if stale:
+        get_executor('prefetch', PREFETCH_WORKERS).submit(prefetch_thumbnails, user_id, stale)
+
 def create_export_job(design_id, export_format, access_token):
     """Create an export job for a design."""
-    export_url = "https://api.canva.com/rest/v1/exports"
+    export_url = f"{CANVA_API_URL}/exports"
     data = {
         "design_id": design_id,
         "format": {
@@ -455,46 +2683,488 @@ def create_export_job(design_id, export_format, access_token):
         "Authorization": f"Bearer {access_token}",
         "Content-Type": "application/json"
     }
-    response = requests.post(export_url, headers=headers, json=data)
+    with upstream_span('canva', 'create_export') as span:
+        response = http_session.post(export_url, headers=headers, json=data)
+        span.status = response.status_code
     return response
 
 def get_export_status(export_job_id, access_token):
     """Get the status of an export job."""
-    export_status_url = f"https://api.canva.com/rest/v1/exports/{export_job_id}"
+    export_status_url = f"{CANVA_API_URL}/exports/{export_job_id}"
     headers = {
         "Authorization": f"Bearer {access_token}"
     }
-    response = requests.get(export_status_url, headers=headers)
-    # if response.status_code == 200:
+    with upstream_span('canva', 'export_status') as span:
+        response = http_session.get(export_status_url, headers=headers)
+        span.status = response.status_code
     return response
 
-def poll_export_status(export_job_id, access_token, max_retries=10, interval=10):
-    """Poll the status of an export job until it is completed or the maximum retries are reached."""
-    for attempt in range(max_retries):
-        response = get_export_status(export_job_id, access_token)
-        if response.status_code == 200:
-            export_job_details = response.json().get("job", {})
-            status = export_job_details.get("status")
-            if status == "success":
-                return export_job_details.get("urls", [])
-            elif status == "failed":
-                print("Export job failed.")
-                return None
+def poll_export_status_steps(io, export_job_id, access_token, timeout=EXPORT_TIMEOUT, initial_interval=1, max_interval=10, backoff=1.5):
+    """Poll the status of an export job with adaptive backoff until it completes or the timeout expires."""
+    deadline = time.time() + timeout
+    interval = initial_interval
+    iterations = 0
+    try:
+        while True:
+            iterations += 1
+            response = yield io.get_export_status(export_job_id, access_token)
+            if response.status_code == 200:
+                export_job_details = response.json().get("job", {})
+                status = export_job_details.get("status")
+                if status == "success":
+                    return export_job_details.get("urls", [])
+                elif status == "failed":
+                    logging.error("Export job failed.")
+                    return None
+            elif response.status_code == 429:
+                # Canva is throttling us, back off harder
+                interval = max_interval
+            else:
+                logging.warning(f"Failed to get export status: {response.status_code}")
+
+            if time.time() + interval > deadline:
+                break
+            yield io.sleep(interval)
+            interval = min(interval * backoff, max_interval)
+        logging.error("Timed out waiting for the export job to complete.")
+        return None
+    finally:
+        poll_iterations['export'].observe(iterations)
+
+# Background export pipeline: the webhook enqueues exports and worker threads deliver them
+export_queue = queue.Queue()
+export_workers = []
+export_workers_lock = threading.Lock()
+export_stats = {'in_flight': 0, 'succeeded': 0, 'failed': 0}
+export_latency = Histogram('instacanva_export_latency_seconds', [5, 10, 20, 30, 60, 90, 120, 180])
+
+def start_export_workers():
+    """Start the export worker threads once per process (safe after a Gunicorn fork)."""
+    with export_workers_lock:
+        alive = [worker for worker in export_workers if worker.is_alive()]
+        if len(alive) >= EXPORT_WORKERS:
+            return
+        export_workers[:] = alive
+        for _ in range(EXPORT_WORKERS - len(alive)):
+            worker = threading.Thread(target=export_worker, daemon=True)
+            worker.start()
+            export_workers.append(worker)
+
+def enqueue_export(design_ids, export_format, access_token, to, titles=None):
+    """Queue an export of one or more designs, sent to the user in one WhatsApp message once ready.
+
+    Returns False without queueing anything when EXPORT_MAX_IN_FLIGHT exports are already queued or running.
+    """
+    if not export_limit.acquire():
+        return False
+    start_export_workers()
+    export_queue.put({
+        'design_ids': list(design_ids),
+        'format': export_format,
+        'access_token': access_token,
+        'to': to,
+        'titles': titles or [],
+        'enqueued_at': time.time(),
+    })
+    return True
+
+def export_worker():
+    while True:
+        job = export_queue.get()
+        export_stats['in_flight'] += 1
+        try:
+            with traced('export_job', designs=len(job['design_ids'])):
+                run_export(job)
+        except Exception as e:
+            export_stats['failed'] += 1
+            logging.error(f"Export of designs {job['design_ids']} failed: {e}")
+        finally:
+            export_stats['in_flight'] -= 1
+            export_limit.release()
+            export_queue.task_done()
+
+# Finished exports keyed by (design_id, format, updated_at), kept until their signed URLs expire
+export_cache = register_cache(TTLCache('exports', EXPORT_URL_TTL, EXPORT_CACHE_SIZE))
+# Identical exports that arrive while one is running share its Canva job
+export_flights = register_flight(SingleFlight('exports'))
+
+def export_cache_key_steps(io, design_id, export_format, access_token):
+    """Key an export on the design revision, or return None if the revision is unknown."""
+    # Always ask Canva for a fresh updated_at so an edited design is never served from an old export
+    metadata = yield io.get_design_metadata(design_id, access_token, use_cache=False)
+    updated_at = (metadata or {}).get('design', {}).get('updated_at')
+    if updated_at is None:
+        return None
+    return (design_id, export_format, updated_at)
+
+def export_urls_ttl(urls):
+    """Return how many seconds the signed export URLs can still be handed out."""
+    expiries = []
+    for url in urls:
+        params = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+        if 'X-Amz-Date' in params and 'X-Amz-Expires' in params:
+            signed_at = calendar.timegm(time.strptime(params['X-Amz-Date'][0], '%Y%m%dT%H%M%SZ'))
+            expiries.append(signed_at + int(params['X-Amz-Expires'][0]))
+        elif 'Expires' in params:
+            expiries.append(int(params['Expires'][0]))
+    expires_at = min(expiries) if expiries else time.time() + EXPORT_URL_TTL
+    # Leave Twilio enough time to fetch the files after we send the message
+    return expires_at - time.time() - EXPORT_URL_SAFETY_MARGIN
+
+def export_design_steps(io, design_id, export_format, access_token):
+    """Create an export job and wait for it, returning the download URLs or None."""
+    create_export = yield io.create_export_job(design_id, export_format, access_token)
+    if create_export.status_code != 200:
+        logging.error(f"Failed to create export job: {create_export.status_code}")
+        return None
+    export_job_id = create_export.json().get("job", {}).get('id')
+    return (yield from poll_export_status_steps(io, export_job_id, access_token))
+
+def export_design_cached_steps(io, design_id, export_format, access_token):
+    """Export a design, reusing a cached export or joining an identical export already in flight."""
+    key = yield from export_cache_key_steps(io, design_id, export_format, access_token)
+    if key is None:
+        return (yield from export_design_steps(io, design_id, export_format, access_token))
+
+    urls = export_cache.get(key)
+    if urls:
+        return urls
+
+    def export_and_cache():
+        started = time.time()
+        urls = yield from export_design_steps(io, design_id, export_format, access_token)
+        if urls:
+            ttl = export_urls_ttl(urls)
+            if ttl > 0:
+                export_cache.set(key, urls, time.time() - started, ttl=ttl)
+        return urls
+
+    return (yield io.share('exports', key, export_and_cache))
+
+def run_export(job):
+    """Export every design of the job concurrently and deliver the files together."""
+    def export_one(design_id):
+        try:
+            return run_steps(export_design_cached_steps(blocking_io, design_id, job['format'], job['access_token']))
+        except Exception as e:
+            logging.error(f"Export of design {design_id} failed: {e}")
+            return None
+
+    pool = get_executor('export', EXPORT_FANOUT_WORKERS)
+    # Each design runs in a copy of this context so its upstream spans land in the job's trace
+    futures = [pool.submit(contextvars.copy_context().run, export_one, design_id) for design_id in job['design_ids']]
+    results = [future.result() for future in futures]
+    urls = [url for design_urls in results if design_urls for url in design_urls]
+    deliver_export(job, urls[:EXPORT_MAX_FILES], failed=results.count(None))
+
+def deliver_export(job, urls, failed=0):
+    """Send the exported files (or an error) back to the user who asked for them."""
+    if urls:
+        export_stats['succeeded'] += 1
+        body = "Here's what you requested!"
+        if failed:
+            body += f" ({failed} of your designs could not be exported.)"
+        # The summary goes with the first file and the rest follow as media-only messages
+        for start in range(0, len(urls), WHATSAPP_MAX_MEDIA_PER_MESSAGE):
+            notify_whatsapp(job['to'], '' if start else body, media_url=urls[start:start + WHATSAPP_MAX_MEDIA_PER_MESSAGE])
+    else:
+        export_stats['failed'] += 1
+        notify_whatsapp(job['to'], "There was an error exporting your design. Please try again.")
+    export_latency.observe(time.time() - job['enqueued_at'])
+
+twilio_client = None
+
+def get_twilio_client():
+    """Return the shared Twilio REST client, importing twilio.rest (slow) and creating it on first use."""
+    global twilio_client
+    if twilio_client is None:
+        from twilio.http.http_client import TwilioHttpClient
+        from twilio.rest import Client
+        # Without a timeout a stalled Twilio request would hold a dispatcher thread (and its claim) forever.
+        # Twilio takes a single number, used for the connect and for each read.
+        http_client = TwilioHttpClient(timeout=HTTP_READ_TIMEOUT)
+        client = Client(twilio_account_sid, twilio_auth_token, http_client=http_client)
+        client.api.base_url = TWILIO_BASE_URL
+        twilio_client = client
+    return twilio_client
+
+def send_whatsapp_message(to, body, media_url=None):
+    """Send a WhatsApp message through the Twilio REST API."""
+    kwargs = {'media_url': media_url} if media_url else {}
+    with upstream_span('twilio', 'send_message'):
+        message = get_twilio_client().messages.create(
+            body=body,
+            to=to if to.startswith('whatsapp:') else f'whatsapp:{to}',
+            from_=f'whatsapp:{twilio_phone_number}',
+            **kwargs
+        )
+    return message
+
+class BlockingIO:
+    """The calls a *_steps flow yields, made directly on the calling thread (see run_steps).
+
+    db() wraps local SQLite work, share() runs a nested flow as the leader of a named
+    SingleFlight, and the calls that are not yielded (enqueue_export, submit_upload_batch,
+    start_chat_reply) hand work to the background and return right away.
+    """
+
+    flights = {'chat_replies': chat_flights, 'exports': export_flights, 'asset_uploads': asset_upload_flights}
+
+    def db(self, fn, *args):
+        return fn(*args)
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def share(self, flight, key, make_steps):
+        return self.flights[flight].do(key, lambda: run_steps(make_steps()))
+
+    def next_chunk(self, stream):
+        return next(stream, None)
+
+    def start_chat_reply(self, user_input, to, received_at):
+        get_executor('chat', CHAT_WORKERS).submit(watsonx_limit.release_after, stream_chat_reply, user_input, to, received_at)
+
+    get_access_token = staticmethod(token_store.get)
+    list_designs = staticmethod(list_designs)
+    create_design = staticmethod(create_design)
+    get_design_metadata = staticmethod(get_design_metadata)
+    create_export_job = staticmethod(create_export_job)
+    get_export_status = staticmethod(get_export_status)
+    download_media = staticmethod(download_media)
+    upload_asset = staticmethod(upload_asset_to_canva)
+    get_asset_upload_status = staticmethod(get_asset_upload_status)
+    get_asset = staticmethod(get_asset)
+    generate_reply = staticmethod(generate_natural_language_reply)
+    stream_reply = staticmethod(stream_natural_language_input)
+    send_whatsapp_message = staticmethod(send_whatsapp_message)
+    enqueue_export = staticmethod(enqueue_export)
+    submit_upload_batch = staticmethod(submit_upload_batch)
+
+blocking_io = BlockingIO()
+
+# Notifications are spooled to SQLite first, so a restart or a provider outage never loses
+# one; dispatcher threads deliver them with retries, and the queue only wakes them up early
+notification_queue = queue.Queue(maxsize=NOTIFY_QUEUE_SIZE)
+notification_workers = []
+notification_workers_lock = threading.Lock()
+notification_stats = {'sent': 0, 'retried': 0, 'failed': 0, 'digested': 0}
+# A claim must outlast the send it covers (Twilio and SendGrid allow HTTP_READ_TIMEOUT for the
+# connect and again for the read) plus the SQLite write that records it (30 s busy timeout),
+# or another dispatcher could pick the notification up and send it a second time
+NOTIFY_CLAIM_SECONDS = 2 * HTTP_READ_TIMEOUT + 30
+
+def start_notification_dispatcher():
+    """Start the dispatcher threads once per process; they also drain anything spooled before a restart."""
+    with notification_workers_lock:
+        alive = [worker for worker in notification_workers if worker.is_alive()]
+        if len(alive) >= NOTIFY_WORKERS:
+            return
+        notification_workers[:] = alive
+        for _ in range(NOTIFY_WORKERS - len(alive)):
+            worker = threading.Thread(target=notification_worker, daemon=True)
+            worker.start()
+            notification_workers.append(worker)
+
+def spool_notification(kind, payload, digest_key=None):
+    """Persist a notification and wake a dispatcher thread."""
+    now = time.time()
+    # Digest notifications wait for the window to collect the rest of the burst
+    next_attempt_at = now + NOTIFY_DIGEST_WINDOW if digest_key else now
+    notification_id = get_db().execute(
+        'INSERT INTO notifications (kind, payload, digest_key, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?)',
+        (kind, json.dumps(payload, separators=(',', ':')), digest_key, next_attempt_at, now)
+    ).lastrowid
+    start_notification_dispatcher()
+    if not digest_key:
+        try:
+            notification_queue.put_nowait(notification_id)
+        except queue.Full:
+            # Still spooled; the next poll of the spool will pick it up
+            pass
+    return notification_id
+
+def notify_email(subject, html_content, to_email, digest_key=None):
+    """Send an email in the background, optionally batched with others sharing digest_key."""
+    return spool_notification('email', {'subject': subject, 'html_content': html_content, 'to': to_email}, digest_key)
+
+def notify_whatsapp(to, body, media_url=None):
+    """Send a WhatsApp message in the background."""
+    return spool_notification('whatsapp', {'to': to, 'body': body, 'media_url': media_url})
+
+def claim_notification(notification_id=None):
+    """Claim a due notification (or a specific one) so no other thread or worker sends it."""
+    db = get_db()
+    now = time.time()
+    if notification_id is None:
+        row = db.execute(
+            "SELECT id, kind, payload, digest_key, attempts FROM notifications "
+            "WHERE status = 'pending' AND next_attempt_at <= ? AND claimed_until < ? ORDER BY id LIMIT 1",
+            (now, now)
+        ).fetchone()
+    else:
+        row = db.execute(
+            "SELECT id, kind, payload, digest_key, attempts FROM notifications "
+            "WHERE id = ? AND status = 'pending' AND next_attempt_at <= ? AND claimed_until < ?",
+            (notification_id, now, now)
+        ).fetchone()
+    if row is None:
+        return None
+    claimed = db.execute(
+        'UPDATE notifications SET claimed_until = ? WHERE id = ? AND claimed_until < ?',
+        (now + NOTIFY_CLAIM_SECONDS, row[0], now)
+    ).rowcount
+    if not claimed:
+        return None
+    return {'id': row[0], 'kind': row[1], 'payload': json.loads(row[2]), 'digest_key': row[3], 'attempts': row[4]}
+
+def claim_digest(notification):
+    """Claim every pending notification batched with this one and merge them into one email."""
+    db = get_db()
+    now = time.time()
+    payload = notification['payload']
+    rows = db.execute(
+        "SELECT id, payload FROM notifications WHERE status = 'pending' AND digest_key = ? AND id != ? AND claimed_until < ?",
+        (notification['digest_key'], notification['id'], now)
+    ).fetchall()
+    ids = [notification['id']]
+    contents = [payload['html_content']]
+    for row_id, row_payload in rows:
+        other = json.loads(row_payload)
+        if other['to'] != payload['to']:
+            continue
+        claimed = db.execute(
+            'UPDATE notifications SET claimed_until = ? WHERE id = ? AND claimed_until < ?',
+            (now + NOTIFY_CLAIM_SECONDS, row_id, now)
+        ).rowcount
+        if claimed:
+            ids.append(row_id)
+            contents.append(other['html_content'])
+    if len(ids) > 1:
+        counts = OrderedDict()
+        for content in contents:
+            counts[content] = counts.get(content, 0) + 1
+        sections = [
+            content if count == 1 else f"<p><strong>{count}×</strong></p>{content}"
+            for content, count in counts.items()
+        ]
+        payload = dict(payload, subject=f"{payload['subject']} ({len(ids)})", html_content='<hr>'.join(sections))
+    return ids, payload
+
+def deliver_notification(notification):
+    """Send one claimed notification (or digest), rescheduling it with backoff on failure."""
+    ids = [notification['id']]
+    payload = notification['payload']
+    if notification['kind'] == 'email' and notification['digest_key']:
+        ids, payload = claim_digest(notification)
+
+    try:
+        if notification['kind'] == 'email':
+            sent = send_email(payload['subject'], payload['html_content'], payload['to'])
         else:
-            print(f"Failed to get export status: {response.status_code}")
+            send_whatsapp_message(payload['to'], payload['body'], media_url=payload.get('media_url'))
+            sent = True
+    except Exception as e:
+        logging.error(f"Failed to send {notification['kind']} notification: {e}")
+        sent = False
+
+    db = get_db()
+    placeholders = ','.join('?' * len(ids))
+    if sent:
+        notification_stats['sent'] += 1
+        notification_stats['digested'] += len(ids) - 1
+        db.execute(f'DELETE FROM notifications WHERE id IN ({placeholders})', ids)
+        return
+
+    attempts = notification['attempts'] + 1
+    if attempts >= NOTIFY_MAX_ATTEMPTS:
+        notification_stats['failed'] += 1
+        logging.error(f"Giving up on {notification['kind']} notification {ids} after {attempts} attempts")
+        # next_attempt_at records when it failed, for prune_failed_notifications
+        db.execute(
+            f"UPDATE notifications SET status = 'failed', attempts = ?, next_attempt_at = ? WHERE id IN ({placeholders})",
+            [attempts, time.time()] + ids
+        )
+        return
+    notification_stats['retried'] += 1
+    delay = min(NOTIFY_RETRY_BASE * 2 ** (attempts - 1), NOTIFY_RETRY_MAX)
+    delay += random.uniform(0, delay / 2)
+    db.execute(
+        f'UPDATE notifications SET attempts = ?, next_attempt_at = ?, claimed_until = 0 WHERE id IN ({placeholders})',
+        [attempts, time.time() + delay] + ids
+    )
 
-        time.sleep(interval)
-    print("Max retries reached. Export job did not complete.")
-    return None
+def prune_failed_notifications():
+    """Delete notifications that failed more than NOTIFY_FAILED_RETENTION seconds ago."""
+    get_db().execute(
+        "DELETE FROM notifications WHERE status = 'failed' AND next_attempt_at < ?",
+        (time.time() - NOTIFY_FAILED_RETENTION,)
+    )
+
+def notification_worker():
+    while True:
+        try:
+            notification_id = notification_queue.get(timeout=NOTIFY_POLL_INTERVAL)
+        except queue.Empty:
+            notification_id = None
+        try:
+            if notification_id is None:
+                # Idle: a good moment to clear out failures nobody looked at
+                prune_failed_notifications()
+            if notification_id is not None:
+                notification = claim_notification(notification_id)
+                if notification:
+                    with traced('notification', kind=notification['kind']):
+                        deliver_notification(notification)
+            # Drain whatever else is due: retries, digests and anything left from before a restart
+            while True:
+                notification = claim_notification()
+                if notification is None:
+                    break
+                with traced('notification', kind=notification['kind']):
+                    deliver_notification(notification)
+        except Exception as e:
+            logging.error(f"Notification dispatcher error: {e}")
+
+@register_metrics
+def notification_metrics():
+    pending = get_db().execute("SELECT COUNT(*) FROM notifications WHERE status = 'pending'").fetchone()[0]
+    lines = [
+        "# TYPE instacanva_notifications_pending gauge",
+        f"instacanva_notifications_pending {pending}",
+        "# TYPE instacanva_notification_queue_depth gauge",
+        f"instacanva_notification_queue_depth {notification_queue.qsize()}",
+    ]
+    for name, value in notification_stats.items():
+        lines.append(f"# TYPE instacanva_notifications_{name}_total counter")
+        lines.append(f"instacanva_notifications_{name}_total {value}")
+    return lines
+
+@register_metrics
+def export_metrics():
+    lines = [
+        "# TYPE instacanva_export_queue_depth gauge",
+        f"instacanva_export_queue_depth {export_queue.qsize()}",
+        "# TYPE instacanva_export_in_flight gauge",
+        f"instacanva_export_in_flight {export_stats['in_flight']}",
+        "# TYPE instacanva_export_succeeded_total counter",
+        f"instacanva_export_succeeded_total {export_stats['succeeded']}",
+        "# TYPE instacanva_export_failed_total counter",
+        f"instacanva_export_failed_total {export_stats['failed']}",
+        "# TYPE instacanva_export_latency_seconds histogram",
+    ]
+    lines.extend(export_latency.lines())
+    return lines
 
 @app.route('/create-design', methods=['POST'])
 def create_design_route():
     """Route to create a design."""
-    if 'access_token' not in Token_Response:
+    access_token = token_store.get(session.get('user_id'))
+    if not access_token:
         return jsonify({'error': 'Authentication required'}), 403
 
     design_data = request.json
-    design = create_design(design_data, Token_Response['access_token'])
+    design = create_design(design_data, access_token)
     if design:
         return jsonify(design)
     else:
@@ -503,22 +3173,46 @@ def create_design_route():
 @app.route('/list-designs', methods=['GET'])
 def list_designs_route():
     """Route to list designs."""
-    if 'access_token' not in Token_Response:
+    access_token = token_store.get(session.get('user_id'))
+    if not access_token:
         return jsonify({'error': 'Authentication required'}), 403
 
-    designs = list_designs(Token_Response['access_token'])
+    designs = list_designs(access_token)
     if designs:
         return jsonify(designs)
     else:
         return jsonify({'error': 'Failed to list designs'}), 500
 
+THUMBNAIL_KEY_PATTERN = re.compile(r'[0-9a-f]{64}')
+
+@app.route('/thumbnails/<key>', methods=['GET'])
+def thumbnail_route(key):
+    """Serve a cached design thumbnail (Twilio fetches the images attached to replies from here)."""
+    found = thumbnail_cache.open(key) if THUMBNAIL_KEY_PATTERN.fullmatch(key) else None
+    if found is None:
+        return jsonify({'error': 'Thumbnail not found'}), 404
+    mapped, content_type = found
+
+    def stream():
+        try:
+            for offset in range(0, len(mapped), MEDIA_CHUNK_SIZE):
+                yield mapped[offset:offset + MEDIA_CHUNK_SIZE]
+        finally:
+            mapped.close()
+
+    return app.response_class(stream(), mimetype=content_type, headers={
+        'Content-Length': str(len(mapped)),
+        'Cache-Control': 'private, max-age=3600',
+    })
+
 @app.route('/design/<design_id>', methods=['GET'])
 def get_design_metadata_route(design_id):
     """Route to get design metadata."""
-    if 'access_token' not in Token_Response:
+    access_token = token_store.get(session.get('user_id'))
+    if not access_token:
         return jsonify({'error': 'Authentication required'}), 403
 
-    metadata = get_design_metadata(design_id, Token_Response['access_token'])
+    metadata = get_design_metadata(design_id, access_token)
     if metadata:
         return jsonify(metadata)
     else:
@@ -527,11 +3221,12 @@ def get_design_metadata_route(design_id):
 @app.route('/export-job', methods=['POST'])
 def create_export_job_route():
     """Route to create an export job."""
-    if 'access_token' not in Token_Response:
+    access_token = token_store.get(session.get('user_id'))
+    if not access_token:
         return jsonify({'error': 'Authentication required'}), 403
 
     data = request.json
-    export_job = create_export_job(data['design_id'], data['format'], Token_Response['access_token'])
+    export_job = create_export_job(data['design_id'], data['format'], access_token)
     if export_job:
         return jsonify(export_job)
     else:
@@ -540,21 +3235,23 @@ def create_export_job_route():
 @app.route('/export-job/<export_job_id>', methods=['GET'])
 def get_export_status_route(export_job_id):
     """Route to get export job status."""
-    if 'access_token' not in Token_Response:
+    access_token = token_store.get(session.get('user_id'))
+    if not access_token:
         return jsonify({'error': 'Authentication required'}), 403
 
-    status = get_export_status(export_job_id, Token_Response['access_token'])
+    status = get_export_status(export_job_id, access_token)
     if status:
         return jsonify(status)
     else:
         return jsonify({'error': 'Failed to get export status'}), 500
 
-@app.route('/print-session')
-def print_session():
-    """Print all the values in the session."""
-    for key, value in session.items():
-        print(f'{key}: {value}')
-    return "Session values have been printed to the console."
+@app.route('/metrics')
+def metrics():
+    """Expose internal counters in the Prometheus text format."""
+    lines = []
+    for collector in METRICS_COLLECTORS:
+        lines.extend(collector())
+    return '\n'.join(lines) + '\n', 200, {'Content-Type': 'text/plain; version=0.0.4'}
 
 # if __name__ == '__main__':
 #     app.run(port=8000, debug=False)
@@ -0,0 +1,591 @@
+"""ASGI entry point: the WhatsApp webhook and its Canva, IBM and Twilio calls run on asyncio.
+
+Every upstream call in app.py blocks a Waitress thread while it waits on the network, so
+the number of webhooks in flight is capped by WEB_THREADS. Here /whatsapp is served by
+coroutines sharing one pooled aiohttp session, so a single process can hold thousands of
+in-flight webhooks. The message handling itself is app.py's: its *_steps flows yield
+each call they need, and AsyncIO answers them with the aiohttp calls below, or runs them
+on a thread pool for SQLite and the token store. Every other route is the Flask app, run
+through a WSGI adapter.
+
+Run with: uvicorn asgi:app --host 0.0.0.0 --port 8000
+"""
+import asyncio
+import contextvars
+import functools
+import json
+import logging
+import os
+import random
+import time
+import urllib.parse
+from email.utils import parsedate_to_datetime
+
+import aiohttp
+from asgiref.wsgi import WsgiToAsgi
+
+import app as instacanva
+
+# Connections held open to each upstream by the shared async client
+ASYNC_MAX_CONNECTIONS = int(os.environ.get('ASYNC_MAX_CONNECTIONS', 500))
+# Design exports and chatbot generations running at once in the background
+ASYNC_EXPORT_CONCURRENCY = int(os.environ.get('ASYNC_EXPORT_CONCURRENCY', 32))
+ASYNC_CHAT_CONCURRENCY = int(os.environ.get('ASYNC_CHAT_CONCURRENCY', 64))
+# Media files streamed from Twilio into Canva at once, across all senders
+ASYNC_UPLOAD_CONCURRENCY = int(os.environ.get('ASYNC_UPLOAD_CONCURRENCY', 32))
+# Threads for each kind of call that is still blocking (SQLite, IAM and Canva token refreshes)
+ASYNC_BLOCKING_WORKERS = int(os.environ.get('ASYNC_BLOCKING_WORKERS', 8))
+
+http_client = None
+http_client_loop = None
+# Created on the serving event loop (asyncio primitives bind to a loop on Python < 3.10)
+semaphores = {}
+# Strong references to fire-and-forget tasks, so they are not garbage collected mid-flight
+background_tasks = set()
+webhook_stats = {'in_flight': 0}
+
+def get_http_client():
+    """Return the process-wide aiohttp session, creating it on first use on the running loop."""
+    global http_client, http_client_loop
+    loop = asyncio.get_running_loop()
+    if http_client is None or http_client.closed or http_client_loop is not loop:
+        # One connector for every upstream; its cost stays flat with thousands of open connections
+        http_client = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=ASYNC_MAX_CONNECTIONS, limit_per_host=ASYNC_MAX_CONNECTIONS),
+            timeout=client_timeout(instacanva.HTTP_READ_TIMEOUT),
+        )
+        http_client_loop = loop
+    return http_client
+
+def client_timeout(read_timeout):
+    return aiohttp.ClientTimeout(total=None, connect=instacanva.HTTP_CONNECT_TIMEOUT, sock_read=read_timeout)
+
+class UpstreamResponse:
+    """A fully read upstream response, shaped like the requests responses app.py caches."""
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+def get_semaphore(name, limit):
+    semaphore = semaphores.get(name)
+    if semaphore is None:
+        semaphore = semaphores[name] = asyncio.Semaphore(limit)
+    return semaphore
+
+async def run_blocking(pool, fn, *args):
+    """Run a blocking call on a named thread pool without stalling the event loop.
+
+    Each kind of call gets its own pool, so a slow IAM refresh never queues up token lookups.
+    """
+    executor = instacanva.get_executor(f'asgi_{pool}', ASYNC_BLOCKING_WORKERS)
+    # run_in_executor does not carry contextvars over, so spans would miss the current trace
+    call = functools.partial(contextvars.copy_context().run, fn, *args)
+    return await asyncio.get_running_loop().run_in_executor(executor, call)
+
+def spawn(coro):
+    """Run a coroutine in the background, keeping it alive until it finishes."""
+    task = asyncio.get_running_loop().create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def run_steps(steps):
+    """Run a *_steps flow from app.py, awaiting each call it yields (see AsyncIO)."""
+    result = error = None
+    while True:
+        try:
+            call = steps.send(result) if error is None else steps.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            result, error = await call, None
+        except Exception as e:
+            # Raised inside the flow, where its own try/except can handle it
+            result, error = None, e
+
+async def release_after(limit, coro):
+    """Await coro, which runs with a slot of limit acquired beforehand, then release the slot."""
+    try:
+        return await coro
+    finally:
+        limit.release()
+
+def retry_after(response, attempt):
+    """Seconds to wait before replaying a throttled or failed request."""
+    header = response.headers.get('Retry-After') if response is not None else None
+    if header:
+        try:
+            return max(0.0, float(header))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(header).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    return 0.5 * (2 ** attempt) + random.uniform(0, 0.5)
+
+async def request(method, url, upstream, operation, max_retries=instacanva.HTTP_MAX_RETRIES, **kwargs):
+    """Send a request, replaying it on connection errors, throttling and gateway errors.
+
+    A POST is only replayed when the connection never opened or it was throttled (see
+    app.may_replay). The whole exchange, retries included, is timed as one upstream span.
+    """
+    client = get_http_client()
+    with instacanva.upstream_span(upstream, operation) as span:
+        for attempt in range(max_retries + 1):
+            try:
+                async with client.request(method, url, **kwargs) as raw_response:
+                    response = UpstreamResponse(raw_response.status, raw_response.headers, await raw_response.read())
+            except aiohttp.ClientConnectorError:
+                # The connection never opened, so nothing was sent
+                if attempt == max_retries:
+                    raise
+                await asyncio.sleep(retry_after(None, attempt))
+                continue
+            except aiohttp.ServerDisconnectedError:
+                # Usually a stale keep-alive connection, but the request may have been handled already
+                if attempt == max_retries or not instacanva.may_replay(method):
+                    raise
+                await asyncio.sleep(retry_after(None, attempt))
+                continue
+            span.status = response.status_code
+            if not instacanva.may_replay(method, response.status_code) or attempt == max_retries:
+                return response
+            await asyncio.sleep(retry_after(response, attempt))
+        return response
+
+class AsyncSingleFlight:
+    """SingleFlight for coroutines: concurrent calls sharing a key await one execution."""
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = {}
+        self.stats = {'leaders': 0, 'followers': 0}
+
+    async def do(self, key, fn):
+        future = self.calls.get(key)
+        if future is not None:
+            self.stats['followers'] += 1
+            return await asyncio.shield(future)
+
+        self.stats['leaders'] += 1
+        future = self.calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await fn()
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved when nobody else was waiting for it
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            if not future.done():
+                # The leader was cancelled; do not leave the followers waiting forever
+                future.cancel()
+            self.calls.pop(key, None)
+
+chat_flights = instacanva.register_flight(AsyncSingleFlight('chat_replies_async'))
+export_flights = instacanva.register_flight(AsyncSingleFlight('exports_async'))
+asset_upload_flights = instacanva.register_flight(AsyncSingleFlight('asset_uploads_async'))
+
+# Canva
+
+def canva_headers(access_token, content_type=None):
+    headers = {"Authorization": f"Bearer {access_token}"}
+    if content_type:
+        headers["Content-Type"] = content_type
+    return headers
+
+async def list_designs(access_token, search, ownership="any", sort_by="modified_descending", continuation=None):
+    """List one page of designs (shares the listing cache with app.list_designs)."""
+    cache_key = (access_token, search, ownership, sort_by, continuation)
+    cached = instacanva.designs_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    query_params = {"query": search, "ownership": ownership, "sort_by": sort_by}
+    if continuation:
+        query_params["continuation"] = continuation
+    started = time.time()
+    response = await request('GET', f"{instacanva.CANVA_API_URL}/designs", 'canva', 'list_designs', headers=canva_headers(access_token), params=query_params)
+    if response.status_code == 200:
+        instacanva.designs_cache.set(cache_key, response, time.time() - started)
+        return response
+    logging.error(f"Failed to list designs: {response.status_code} {response.text}")
+    return response.status_code
+
+async def get_design_metadata(design_id, access_token, use_cache=True):
+    """Get metadata for a specific design."""
+    cache_key = (access_token, design_id)
+    cached = instacanva.design_metadata_cache.get(cache_key) if use_cache else None
+    if cached is not None:
+        return cached
+
+    started = time.time()
+    response = await request('GET', f"{instacanva.CANVA_API_URL}/designs/{design_id}", 'canva', 'get_design', headers=canva_headers(access_token))
+    if response.status_code == 200:
+        metadata = response.json()
+        instacanva.design_metadata_cache.set(cache_key, metadata, time.time() - started)
+        return metadata
+    logging.error(f"Failed to get design metadata: {response.status_code} {response.text}")
+    return None
+
+async def create_design(data, access_token):
+    """Create a design in Canva, returning True on success."""
+    response = await request(
+        'POST', f"{instacanva.CANVA_API_URL}/designs", 'canva', 'create_design',
+        headers=canva_headers(access_token, "application/json"), json=data
+    )
+    if response.status_code == 200:
+        instacanva.invalidate_design_caches(access_token)
+        return True
+    logging.error(f"Failed to create design: {response.status_code} {response.text}")
+    return None
+
+async def create_export_job(design_id, export_format, access_token):
+    """Create an export job for a design."""
+    data = {"design_id": design_id, "format": {"type": export_format}}
+    return await request(
+        'POST', f"{instacanva.CANVA_API_URL}/exports", 'canva', 'create_export',
+        headers=canva_headers(access_token, "application/json"), json=data
+    )
+
+async def get_export_status(export_job_id, access_token):
+    """Get the status of an export job."""
+    return await request('GET', f"{instacanva.CANVA_API_URL}/exports/{export_job_id}", 'canva', 'export_status', headers=canva_headers(access_token))
+
+async def stream_media(media_response, max_bytes=instacanva.MEDIA_MAX_BYTES, chunk_size=instacanva.MEDIA_CHUNK_SIZE):
+    """Re-yield a streamed download chunk by chunk, enforcing the media size cap."""
+    bytes_read = 0
+    async for chunk in media_response.content.iter_chunked(chunk_size):
+        bytes_read += len(chunk)
+        if bytes_read > max_bytes:
+            raise instacanva.MediaTooLarge(f"Media exceeded the limit of {max_bytes} bytes")
+        yield chunk
+
+async def download_media(media_url):
+    """Download media from Twilio into a SpooledMedia, hashing it as the chunks arrive."""
+    media = instacanva.SpooledMedia()
+    try:
+        with instacanva.upstream_span('twilio', 'media') as span:
+            media_response = await get_http_client().get(media_url)
+            span.status = media_response.status
+        async with media_response:
+            media_response.raise_for_status()
+            content_length = media_response.headers.get('Content-Length')
+            if content_length is not None and int(content_length) > instacanva.MEDIA_MAX_BYTES:
+                raise instacanva.MediaTooLarge(f"Media is {content_length} bytes, the limit is {instacanva.MEDIA_MAX_BYTES}")
+            async for chunk in stream_media(media_response):
+                media.write(chunk)
+    except BaseException:
+        media.close()
+        raise
+    return media
+
+async def read_media(media):
+    media.rewind()
+    while True:
+        chunk = media.read()
+        if not chunk:
+            return
+        yield chunk
+
+async def upload_media_to_canva(media, access_token):
+    """Stream a downloaded file to Canva as a new asset, returning the response with the upload job."""
+    headers = canva_headers(access_token, "application/octet-stream")
+    headers["Asset-Upload-Metadata"] = json.dumps({"name_base64": "TXkgQXdlc29tZSBVcGxvYWQg8J+agA=="})
+    headers["Content-Length"] = str(media.len)
+    # A streamed body cannot be replayed, so the upload itself is never retried
+    with instacanva.upstream_span('canva', 'asset_upload') as span:
+        async with get_http_client().post(f"{instacanva.CANVA_API_URL}/asset-uploads", headers=headers, data=read_media(media)) as raw_response:
+            response = UpstreamResponse(raw_response.status, raw_response.headers, await raw_response.read())
+        span.status = response.status_code
+    return response
+
+async def get_asset_upload_status(upload_job_id, access_token):
+    """Get the status of an asset upload job."""
+    return await request('GET', f"{instacanva.CANVA_API_URL}/asset-uploads/{upload_job_id}", 'canva', 'asset_upload_status', headers=canva_headers(access_token))
+
+async def get_asset(asset_id, access_token):
+    """Get an asset's metadata from Canva."""
+    return await request('GET', f"{instacanva.CANVA_API_URL}/assets/{asset_id}", 'canva', 'get_asset', headers=canva_headers(access_token))
+
+class UserUploads:
+    """A sender's files queued or uploading, and the semaphore that limits how many upload at once."""
+
+    def __init__(self):
+        self.semaphore = asyncio.Semaphore(instacanva.UPLOAD_PER_USER_CONCURRENCY)
+        self.queued = 0
+
+user_uploads = {}
+
+async def run_upload_batch(sender, media_urls, access_token, uploads):
+    """Upload the files of one message concurrently and report the batch once they are all done."""
+    started = time.time()
+
+    async def upload_one(index, media_url):
+        # Wait for the sender's own slot first so a queued album never holds a global one
+        async with uploads.semaphore, get_semaphore('upload', ASYNC_UPLOAD_CONCURRENCY):
+            try:
+                with instacanva.traced('media_upload', file=index):
+                    return await run_steps(instacanva.ingest_media_steps(async_io, media_url, access_token, sender))
+            finally:
+                uploads.queued -= 1
+                if not uploads.queued and user_uploads.get(sender) is uploads:
+                    del user_uploads[sender]
+
+    results = await asyncio.gather(*(upload_one(index, media_url) for index, media_url in enumerate(media_urls)))
+    await run_blocking('db', instacanva.deliver_upload_batch, sender, list(results), started)
+
+def submit_upload_batch(sender, media_urls, access_token):
+    """Start an upload batch on the event loop; drop-in replacement for app.submit_upload_batch."""
+    uploads = user_uploads.get(sender) or UserUploads()
+    if uploads.queued + len(media_urls) > instacanva.UPLOAD_MAX_QUEUED_PER_USER:
+        return False
+    uploads.queued += len(media_urls)
+    user_uploads[sender] = uploads
+    spawn(run_upload_batch(sender, media_urls, access_token, uploads))
+    return True
+
+# Exports
+
+async def run_export(job):
+    """Export every design of the job concurrently and deliver all files in one message."""
+    async def export_one(design_id):
+        async with get_semaphore('export', ASYNC_EXPORT_CONCURRENCY):
+            try:
+                return await run_steps(instacanva.export_design_cached_steps(async_io, design_id, job['format'], job['access_token']))
+            except Exception as e:
+                logging.error(f"Export of design {design_id} failed: {e}")
+                return None
+
+    instacanva.export_stats['in_flight'] += 1
+    try:
+        with instacanva.traced('export_job', designs=len(job['design_ids'])):
+            results = await asyncio.gather(*(export_one(design_id) for design_id in job['design_ids']))
+            urls = [url for design_urls in results if design_urls for url in design_urls]
+            await run_blocking('db', functools.partial(instacanva.deliver_export, job, urls[:instacanva.EXPORT_MAX_FILES], failed=results.count(None)))
+    finally:
+        instacanva.export_stats['in_flight'] -= 1
+        instacanva.export_limit.release()
+
+def enqueue_export(design_ids, export_format, access_token, to, titles=None):
+    """Start an export on the event loop; drop-in replacement for app.enqueue_export."""
+    if not instacanva.export_limit.acquire():
+        return False
+    spawn(run_export({
+        'design_ids': list(design_ids),
+        'format': export_format,
+        'access_token': access_token,
+        'to': to,
+        'titles': titles or [],
+        'enqueued_at': time.time(),
+    }))
+    return True
+
+# Twilio
+
+async def send_whatsapp_message(to, body, media_url=None):
+    """Send a WhatsApp message through the Twilio REST API."""
+    data = [
+        ('To', to if to.startswith('whatsapp:') else f'whatsapp:{to}'),
+        ('From', f'whatsapp:{instacanva.twilio_phone_number}'),
+        ('Body', body),
+    ]
+    if media_url:
+        data.extend(('MediaUrl', url) for url in (media_url if isinstance(media_url, list) else [media_url]))
+    response = await request(
+        'POST', f"{instacanva.TWILIO_API_URL}/Accounts/{instacanva.twilio_account_sid}/Messages.json", 'twilio', 'send_message',
+        auth=aiohttp.BasicAuth(instacanva.twilio_account_sid or '', instacanva.twilio_auth_token or ''), data=data
+    )
+    if response.status_code >= 300:
+        raise Exception(f"Twilio rejected the message: {response.status_code}\n{response.text}")
+    return response.json()
+
+# Watsonx
+
+async def generate_natural_language_reply(chat):
+    """Ask Watsonx for a reply and clean it up."""
+    started = time.time()
+    # The IAM token is almost always cached; a refresh must not block the event loop though
+    headers, body = await run_blocking('ibm', instacanva.build_generation_request, chat)
+    response = await request(
+        'POST', instacanva.IBM_MODEL_URL, 'watsonx', 'generate', headers=headers, json=body,
+        timeout=client_timeout(instacanva.IBM_GENERATION_TIMEOUT)
+    )
+    if response.status_code != 200:
+        raise Exception(f"Non-200 response: {response.status_code}\n{response.text}")
+    result = response.json()['results'][0]
+    instacanva.observe_generation(chat.kind, result, started)
+    generated_text = result['generated_text']
+    cleaner = instacanva.StreamCleaner()
+    return (cleaner.feed(generated_text) + cleaner.flush()).strip()
+
+async def stream_natural_language_input(chat):
+    """Yield the cleaned reply from Watsonx's generation_stream endpoint as it is generated."""
+    started = time.time()
+    headers, body = await run_blocking('ibm', instacanva.build_generation_request, chat)
+    headers["Accept"] = "text/event-stream"
+    timeout = client_timeout(instacanva.IBM_GENERATION_TIMEOUT)
+    # The span covers the whole stream, from the request until the last token is read
+    with instacanva.upstream_span('watsonx', 'generate_stream') as span:
+        async with get_http_client().post(instacanva.IBM_STREAM_URL, headers=headers, json=body, timeout=timeout) as response:
+            span.status = response.status
+            if response.status != 200:
+                raise Exception(f"Non-200 response: {response.status}\n{await response.text()}")
+
+            cleaner = instacanva.StreamCleaner()
+            last = {}
+            async for raw_line in response.content:
+                line = raw_line.decode('utf-8').strip()
+                if not line or not line.startswith('data:'):
+                    continue
+                data = json.loads(line[len('data:'):])
+                for result in data.get('results', []):
+                    last.update({name: value for name, value in result.items() if value is not None})
+                    released = cleaner.feed(result.get('generated_text', ''))
+                    if released:
+                        yield released
+                if cleaner.done:
+                    break
+            instacanva.observe_generation(chat.kind, last, started)
+            released = cleaner.flush()
+            if released:
+                yield released
+
+async def stream_chat_reply(user_input, to, received_at):
+    """Send a chatbot reply to the user, streaming it in sentence-aligned messages when it is not cached."""
+    with instacanva.traced('chat_reply'):
+        async with get_semaphore('chat', ASYNC_CHAT_CONCURRENCY):
+            await run_steps(instacanva.stream_chat_reply_steps(async_io, user_input, to, received_at))
+
+class AsyncIO:
+    """The calls a *_steps flow from app.py yields, as awaitables for run_steps.
+
+    SQLite and the token store run on their own thread pools through run_blocking; the
+    upstream calls are the aiohttp versions above.
+    """
+
+    flights = {'chat_replies': chat_flights, 'exports': export_flights, 'asset_uploads': asset_upload_flights}
+
+    def db(self, fn, *args):
+        return run_blocking('db', fn, *args)
+
+    def sleep(self, seconds):
+        return asyncio.sleep(seconds)
+
+    def share(self, flight, key, make_steps):
+        return self.flights[flight].do(key, lambda: run_steps(make_steps()))
+
+    def get_access_token(self, user_id):
+        # Usually an in-memory hit; a token close to expiry may be rotated with a blocking call
+        return run_blocking('tokens', instacanva.token_store.get, user_id)
+
+    async def stream_reply(self, chat):
+        return stream_natural_language_input(chat)
+
+    async def next_chunk(self, stream):
+        try:
+            return await stream.__anext__()
+        except StopAsyncIteration:
+            return None
+
+    def start_chat_reply(self, user_input, to, received_at):
+        spawn(release_after(instacanva.watsonx_limit, stream_chat_reply(user_input, to, received_at)))
+
+    list_designs = staticmethod(list_designs)
+    create_design = staticmethod(create_design)
+    get_design_metadata = staticmethod(get_design_metadata)
+    create_export_job = staticmethod(create_export_job)
+    get_export_status = staticmethod(get_export_status)
+    download_media = staticmethod(download_media)
+    upload_asset = staticmethod(upload_media_to_canva)
+    get_asset_upload_status = staticmethod(get_asset_upload_status)
+    get_asset = staticmethod(get_asset)
+    generate_reply = staticmethod(generate_natural_language_reply)
+    send_whatsapp_message = staticmethod(send_whatsapp_message)
+    enqueue_export = staticmethod(enqueue_export)
+    submit_upload_batch = staticmethod(submit_upload_batch)
+
+async_io = AsyncIO()
+
+# Webhook
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+async def whatsapp(scope, receive, send):
+    """Handle incoming WhatsApp messages."""
+    received_at = time.time()
+    webhook_stats['in_flight'] += 1
+    trace, token = instacanva.start_trace('/whatsapp')
+    try:
+        instacanva.start_notification_dispatcher()
+        form = urllib.parse.parse_qs((await read_body(receive)).decode('utf-8'))
+        form.update(urllib.parse.parse_qs(scope.get('query_string', b'').decode('utf-8')))
+        raw_msg = form.get('Body', [''])[0]
+        media_urls = instacanva.incoming_media_urls({key: values[0] for key, values in form.items()})
+        sender = form.get('From', [None])[0] or instacanva.RECIPIENT_NO
+        twiml = await run_steps(instacanva.whatsapp_steps(async_io, raw_msg, media_urls, sender, received_at, trace))
+    finally:
+        webhook_stats['in_flight'] -= 1
+        instacanva.finish_trace(trace, token)
+
+    body = twiml.encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'content-type', b'text/xml; charset=utf-8'), (b'content-length', str(len(body)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            get_http_client()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if background_tasks:
+                await asyncio.wait(list(background_tasks), timeout=instacanva.HTTP_READ_TIMEOUT)
+            if http_client is not None:
+                await http_client.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+@instacanva.register_metrics
+def asgi_metrics():
+    return [
+        "# TYPE instacanva_asgi_webhooks_in_flight gauge",
+        f"instacanva_asgi_webhooks_in_flight {webhook_stats['in_flight']}",
+        "# TYPE instacanva_asgi_background_tasks gauge",
+        f"instacanva_asgi_background_tasks {len(background_tasks)}",
+        "# TYPE instacanva_asgi_uploads_queued gauge",
+        f"instacanva_asgi_uploads_queued {sum(uploads.queued for uploads in user_uploads.values())}",
+    ]
+
+flask_app = WsgiToAsgi(instacanva.app)
+
+async def app(scope, receive, send):
+    """ASGI application: /whatsapp runs natively on asyncio, everything else is the Flask app."""
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+    elif scope['type'] == 'http' and scope['path'] == '/whatsapp' and scope['method'] == 'POST':
+        await whatsapp(scope, receive, send)
+    else:
+        await flask_app(scope, receive, send)
@@ -0,0 +1,113 @@
+"""Measure how long a freshly started server takes to answer its first WhatsApp message.
+
+Render spins idle instances down, so the first message after a quiet spell waits for a
+whole process start. Each run starts a new server process against the stand-in upstreams
+and an empty database, then times:
+
+    import       importing the app module, minus bare interpreter startup
+    first ack    process start until the first /whatsapp POST returns its TwiML
+    first reply  process start until the bot's reply to it reaches (mock) Twilio
+
+Usage: python benchmarks/bench_coldstart.py [--runs 5] [--server wsgi] [--server asgi]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(BENCHMARKS, '..')
+sys.path.insert(0, BENCHMARKS)
+
+from loadtest import free_port  # noqa: E402
+from mock_upstreams import start_mock_upstreams  # noqa: E402
+
+MODULES = {'wsgi': 'app', 'asgi': 'asgi'}
+
+
+def server_command(server, port):
+    if server == 'wsgi':
+        return [sys.executable, '-m', 'waitress', '--host=127.0.0.1', f'--port={port}', 'app:app']
+    return [sys.executable, '-m', 'uvicorn', 'asgi:app', '--host', '127.0.0.1', '--port', str(port), '--log-level', 'warning', '--no-access-log']
+
+
+def wall_time(command, env):
+    started = time.perf_counter()
+    subprocess.run(command, cwd=ROOT, env=env, check=True)
+    return time.perf_counter() - started
+
+
+def fresh_env(base_env):
+    env = dict(base_env)
+    env['DATABASE_PATH'] = os.path.join(tempfile.mkdtemp(prefix='instacanva-coldstart-'), 'instacanva.db')
+    return env
+
+
+def first_message(server, env, state, timeout=30):
+    """Start the server and send it one chat message, returning (seconds to ack, seconds to reply)."""
+    port = free_port()
+    body = urllib.parse.urlencode({'Body': 'hello', 'From': 'whatsapp:+15550000001'}).encode()
+    sent_before = state.counts.get('twilio_message', 0)
+    started = time.perf_counter()
+    process = subprocess.Popen(server_command(server, port), cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = started + timeout
+        while True:
+            try:
+                urllib.request.urlopen(f'http://127.0.0.1:{port}/whatsapp', body, timeout=timeout).close()
+                break
+            except (urllib.error.URLError, ConnectionError):
+                if time.perf_counter() > deadline:
+                    raise RuntimeError(f"{server} did not start")
+                time.sleep(0.005)
+        ack = time.perf_counter() - started
+        while state.counts.get('twilio_message', 0) == sent_before:
+            if time.perf_counter() > deadline:
+                raise RuntimeError(f"{server} never sent a reply")
+            time.sleep(0.002)
+        return ack, time.perf_counter() - started
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def describe(values):
+    values = [value * 1000 for value in values]
+    return f"{statistics.median(values):8.0f} {min(values):8.0f} {max(values):8.0f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--server', action='append', choices=sorted(MODULES), help='server to measure (default both)')
+    args = parser.parse_args()
+
+    # Near-instant upstreams, so the numbers are the app's own start-up cost
+    server, state, mock_env = start_mock_upstreams(api_latency=0, generation_latency=0, token_delay=0)
+    base_env = dict(os.environ, **mock_env)
+    base_env['RATE_LIMIT_BURST'] = '0'
+
+    print(f"{'':18} {'median':>8} {'min':>8} {'max':>8}  (ms, {args.runs} runs)")
+    for name in args.server or ['wsgi', 'asgi']:
+        imports, acks, replies = [], [], []
+        for _ in range(args.runs):
+            env = fresh_env(base_env)
+            baseline = wall_time([sys.executable, '-c', 'pass'], env)
+            imports.append(wall_time([sys.executable, '-c', f'import {MODULES[name]}'], env) - baseline)
+            ack, reply = first_message(name, fresh_env(base_env), state)
+            acks.append(ack)
+            replies.append(reply)
+        print(f"{name} import        {describe(imports)}")
+        print(f"{name} first ack     {describe(acks)}")
+        print(f"{name} first reply   {describe(replies)}")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
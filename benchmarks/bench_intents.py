@@ -0,0 +1,44 @@
+"""Benchmark the local intent router over a corpus of real WhatsApp messages.
+
+Usage: python benchmarks/bench_intents.py [corpus_file] [iterations]
+"""
+import os
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app import classify_message  # noqa: E402
+
+
+def main():
+    corpus_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), 'intent_corpus.txt')
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    with open(corpus_path, encoding='utf-8') as corpus_file:
+        messages = [line.strip() for line in corpus_file if line.strip()]
+
+    intents = Counter()
+    for message in messages:
+        intent = classify_message(message)
+        intents[intent.name] += 1
+        print(f"{intent.name:8} {intent.args or ''!s:60} {message}")
+
+    timings = []
+    for message in messages:
+        started = time.perf_counter()
+        for _ in range(iterations):
+            classify_message(message)
+        timings.append((time.perf_counter() - started) / iterations)
+    timings.sort()
+
+    print()
+    print(f"messages: {len(messages)}  iterations: {iterations}")
+    print("intents:", dict(intents))
+    print(f"mean: {sum(timings) / len(timings) * 1e6:.2f} us  "
+          f"p50: {timings[len(timings) // 2] * 1e6:.2f} us  "
+          f"p99: {timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1e6:.2f} us")
+
+
+if __name__ == '__main__':
+    main()
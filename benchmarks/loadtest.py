@@ -0,0 +1,344 @@
+"""Load-test the /whatsapp webhook and compare the WSGI (Waitress) and ASGI (uvicorn) servers.
+
+Each simulated user sends a mix of WhatsApp messages drawn from
+benchmarks/intent_corpus.txt and answers the bot's follow-up questions (design type,
+title, which search result to export) like a real user would. The report shows
+throughput, latency percentiles per intent and the server's memory use.
+
+Usage:
+    python benchmarks/loadtest.py --spawn --mock
+    python benchmarks/loadtest.py --spawn --mock --json results.json --max-p99-ms 1500
+    python benchmarks/loadtest.py --target wsgi=http://localhost:8000 --target asgi=http://localhost:8001
+
+--spawn starts both servers from this checkout on free ports and stops them afterwards.
+--mock starts the stand-in upstreams from benchmarks/mock_upstreams.py, points the
+spawned servers at them and signs every simulated user in to Canva. Each spawned
+server gets its own copy of that signed-in database, so both start equally cold. Without --mock
+the app talks to the upstreams configured in its environment, so use test accounts.
+--max-p99-ms and --max-errors make the run fail, so it can gate a deploy.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+from contextlib import closing
+
+import aiohttp
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+DEFAULT_MIX = 'chat=40,search=25,create=15,media=10,connect=5,upload=5'
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def spawn_servers(threads, env, database=None):
+    """Start Waitress and uvicorn on free ports, returning the targets and their processes.
+
+    With a database, each server gets its own copy of it, so the second server does not
+    start with the caches, uploads and conversations left behind by the first.
+    """
+    wsgi_port, asgi_port = free_port(), free_port()
+    commands = {
+        'wsgi': [sys.executable, '-m', 'waitress', '--host=127.0.0.1', f'--port={wsgi_port}', f'--threads={threads}', 'app:app'],
+        'asgi': [sys.executable, '-m', 'uvicorn', 'asgi:app', '--host', '127.0.0.1', '--port', str(asgi_port), '--log-level', 'warning', '--no-access-log'],
+    }
+    processes = {}
+    for name, command in commands.items():
+        server_env = dict(env, DATABASE_PATH=copy_database(database, name)) if database else env
+        processes[name] = subprocess.Popen(command, cwd=ROOT, env=server_env)
+    targets = {'wsgi': f'http://127.0.0.1:{wsgi_port}', 'asgi': f'http://127.0.0.1:{asgi_port}'}
+    for url in targets.values():
+        wait_until_up(f'{url}/metrics')
+    return targets, processes
+
+
+def copy_database(path, name):
+    """Copy a SQLite database into a <name> directory next to it, returning the new path.
+
+    The directory keeps the copy's thumbnail cache apart from the other servers' too.
+    """
+    copy_path = os.path.join(os.path.dirname(path), name, os.path.basename(path))
+    os.makedirs(os.path.dirname(copy_path))
+    with closing(sqlite3.connect(path)) as source, closing(sqlite3.connect(copy_path)) as target:
+        source.backup(target)
+    return copy_path
+
+
+def wait_until_up(url, timeout=30):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            urllib.request.urlopen(url, timeout=1).close()
+            return
+        except (urllib.error.URLError, ConnectionError):
+            if time.time() > deadline:
+                raise RuntimeError(f"Server at {url} did not start")
+            time.sleep(0.2)
+
+
+def rss_bytes(pid):
+    """Resident set size of a process (Linux only), or None if it cannot be read."""
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+class MemorySampler(threading.Thread):
+    """Track the peak RSS of a server process while the load runs."""
+
+    def __init__(self, pid, interval=0.2):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.start_rss = rss_bytes(pid)
+        self.peak_rss = self.start_rss or 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, rss_bytes(self.pid) or 0)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return self.start_rss, self.peak_rss
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+
+def build_messages(corpus, classify_message):
+    """Group the corpus by the intent the router assigns to each message."""
+    by_intent = defaultdict(list)
+    for message in corpus:
+        by_intent[classify_message(message).name].append(message)
+    return by_intent
+
+
+def follow_up(reply):
+    """Answer the bot's follow-up question like a user would, returning (intent, body) or None."""
+    if 'Reply with a number' in reply:
+        return 'pick', '1'
+    if 'What would you like to create?' in reply:
+        return 'create', str(random.randint(1, 3))
+    if 'give us a title' in reply:
+        return 'create', f'Campaign {random.randint(1, 999)}'
+    return None
+
+
+async def run_load(url, by_intent, weights, total, concurrency, media_url, busy_replies=()):
+    """Send total webhooks from concurrency simulated users, returning (latencies by intent, errors, busy, elapsed)."""
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    busy = defaultdict(int)
+    sent = 0
+    intents = [name for name in weights if name == 'media' and media_url or by_intent.get(name)]
+    intent_weights = [weights[name] for name in intents]
+    connector = aiohttp.TCPConnector(limit=concurrency)
+
+    async with aiohttp.ClientSession(url, connector=connector, timeout=aiohttp.ClientTimeout(total=120)) as client:
+        async def post(intent, form):
+            nonlocal sent
+            sent += 1
+            started = time.perf_counter()
+            try:
+                async with client.post('/whatsapp', data=form) as response:
+                    reply = await response.text() if response.status == 200 else ''
+                    if response.status != 200:
+                        errors[intent] += 1
+                    elif any(text in reply for text in busy_replies):
+                        # Turned away by admission control; answered fast, but not served
+                        busy[intent] += 1
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                reply = ''
+                errors[intent] += 1
+            latencies[intent].append(time.perf_counter() - started)
+            return reply
+
+        async def user(number):
+            # Each simulated user has its own WhatsApp number, so conversations never interleave
+            sender = f'whatsapp:+1555{number:07d}'
+            while sent < total:
+                intent = random.choices(intents, intent_weights)[0]
+                if intent == 'media':
+                    form = {'Body': '', 'From': sender, 'NumMedia': '1', 'MediaUrl0': media_url}
+                else:
+                    form = {'Body': random.choice(by_intent[intent]), 'From': sender}
+                reply = await post(intent, form)
+                answer = follow_up(reply)
+                while answer and sent < total:
+                    reply = await post(answer[0], {'Body': answer[1], 'From': sender})
+                    answer = follow_up(reply)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(user(number) for number in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return {intent: sorted(values) for intent, values in latencies.items()}, errors, busy, elapsed
+
+
+def summarize(latencies, errors, busy, elapsed, memory):
+    """Reduce one run to req/s, memory and latency percentiles per intent (milliseconds)."""
+    all_latencies = sorted(value for values in latencies.values() for value in values)
+    rows = {'all': (all_latencies, sum(errors.values()), sum(busy.values()))}
+    rows.update((intent, (latencies[intent], errors.get(intent, 0), busy.get(intent, 0))) for intent in sorted(latencies))
+    return {
+        'requests': len(all_latencies),
+        'seconds': elapsed,
+        'requests_per_second': len(all_latencies) / elapsed,
+        'rss_start_bytes': memory[0] if memory else None,
+        'rss_peak_bytes': memory[1] if memory else None,
+        'intents': {
+            intent: {
+                'count': len(values),
+                'p50_ms': percentile(values, 0.50) * 1000,
+                'p95_ms': percentile(values, 0.95) * 1000,
+                'p99_ms': percentile(values, 0.99) * 1000,
+                'max_ms': (values[-1] if values else 0) * 1000,
+                'errors': error_count,
+                'busy': busy_count,
+            }
+            for intent, (values, error_count, busy_count) in rows.items()
+        },
+    }
+
+
+def print_report(name, summary):
+    print()
+    print(f"== {name}: {summary['requests']} requests in {summary['seconds']:.1f}s, {summary['requests_per_second']:.1f} req/s")
+    if summary['rss_start_bytes']:
+        print(f"   memory: {summary['rss_start_bytes'] / 2**20:.1f} MB at start, {summary['rss_peak_bytes'] / 2**20:.1f} MB peak")
+    print(f"   {'intent':10} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9} {'errors':>7} {'busy':>7}")
+    for intent, row in summary['intents'].items():
+        print(f"   {intent:10} {row['count']:7} {row['p50_ms']:9.1f} {row['p95_ms']:9.1f} "
+              f"{row['p99_ms']:9.1f} {row['max_ms']:9.1f} {row['errors']:7} {row['busy']:7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--target', action='append', default=[], metavar='NAME=URL', help='server to test (repeatable)')
+    parser.add_argument('--spawn', action='store_true', help='start Waitress and uvicorn from this checkout')
+    parser.add_argument('--mock', action='store_true', help='run the spawned servers against local stand-in upstreams')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=200, help='simulated users sending at once')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'intent weights (default {DEFAULT_MIX})')
+    parser.add_argument('--media-url', help='media file sent with "media" messages (defaults to the mock server)')
+    parser.add_argument('--media-bytes', type=int, default=512 * 1024, help='size of the mock media file')
+    parser.add_argument('--export-latency', type=float, default=2.0, help='seconds until a mock export finishes')
+    parser.add_argument('--threads', type=int, default=4, help='Waitress threads when spawning')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', metavar='PATH', help='also write the results as JSON')
+    parser.add_argument('--max-p99-ms', type=float, help='exit with status 1 if any target\'s overall p99 is higher')
+    parser.add_argument('--max-errors', type=int, help='exit with status 1 if any target has more failed requests')
+    parser.add_argument('--corpus', default=os.path.join(ROOT, 'benchmarks', 'intent_corpus.txt'))
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    env = dict(os.environ)
+    media_url = args.media_url
+    processes = {}
+    try:
+        if args.mock:
+            # The stand-ins get their own process so they do not compete with the load generator for the GIL
+            from mock_upstreams import mock_environment
+            mock_port = free_port()
+            processes['mock'] = subprocess.Popen([
+                sys.executable, os.path.join(ROOT, 'benchmarks', 'mock_upstreams.py'),
+                '--port', str(mock_port), '--export-latency', str(args.export_latency),
+            ], stdout=subprocess.DEVNULL)
+            wait_until_up(f'http://127.0.0.1:{mock_port}/media/1')
+            env.update(mock_environment(f'http://127.0.0.1:{mock_port}'))
+            env['DATABASE_PATH'] = os.path.join(tempfile.mkdtemp(prefix='instacanva-bench-'), 'instacanva.db')
+            # Simulated users send back to back, far faster than a person; unless asked otherwise,
+            # measure the servers rather than the per-sender rate limit
+            env.setdefault('RATE_LIMIT_BURST', '0')
+            media_url = media_url or f'http://127.0.0.1:{mock_port}/media/{args.media_bytes}'
+            os.environ.update(env)
+
+        # Imported after the environment is set up, so the token store uses the benchmark database
+        import app
+        if args.mock:
+            for number in range(args.concurrency):
+                app.token_store.save(f'whatsapp:+1555{number:07d}', {'access_token': f'bench-{number}', 'refresh_token': 'bench', 'expires_in': 86400})
+
+        with open(args.corpus, encoding='utf-8') as corpus_file:
+            corpus = [line.strip() for line in corpus_file if line.strip()]
+        by_intent = build_messages(corpus, app.classify_message)
+        weights = parse_mix(args.mix)
+
+        targets = dict(target.split('=', 1) for target in args.target)
+        if args.spawn:
+            spawned, servers = spawn_servers(args.threads, env, env['DATABASE_PATH'] if args.mock else None)
+            targets.update(spawned)
+            processes.update(servers)
+        if not targets:
+            parser.error('give at least one --target or use --spawn')
+
+        print(f"requests: {args.requests}  concurrency: {args.concurrency}  mix: {args.mix}")
+        results = {}
+        for name, url in targets.items():
+            sampler = MemorySampler(processes[name].pid) if name in processes else None
+            if sampler:
+                sampler.start()
+            latencies, errors, busy, elapsed = asyncio.run(run_load(
+                url, by_intent, weights, args.requests, args.concurrency, media_url, (app.BUSY_REPLY, app.RATE_LIMITED_REPLY)
+            ))
+            results[name] = summarize(latencies, errors, busy, elapsed, sampler.stop() if sampler else None)
+            print_report(name, results[name])
+    finally:
+        # Stop the servers before the stand-in upstreams, so their background exports, uploads
+        # and notifications never fail against a mock that is already gone
+        for name in sorted(processes, key=lambda name: name == 'mock'):
+            processes[name].terminate()
+            processes[name].wait()
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as json_file:
+            json.dump({'settings': vars(args), 'results': results}, json_file, indent=2)
+
+    failed = False
+    for name, summary in results.items():
+        overall = summary['intents']['all']
+        if args.max_p99_ms is not None and overall['p99_ms'] > args.max_p99_ms:
+            print(f"FAIL {name}: p99 {overall['p99_ms']:.1f} ms is above {args.max_p99_ms} ms")
+            failed = True
+        if args.max_errors is not None and overall['errors'] > args.max_errors:
+            print(f"FAIL {name}: {overall['errors']} errors, at most {args.max_errors} allowed")
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,304 @@
+"""Local stand-ins for the Canva, IBM IAM, Watsonx, Twilio and SendGrid APIs.
+
+One threaded HTTP server answers every upstream under its own path prefix, with
+configurable latencies, so the app can be benchmarked without touching real accounts.
+Point the app at it with the environment printed on startup.
+
+Usage: python benchmarks/mock_upstreams.py [--port 9000] [--export-latency 2] ...
+"""
+import argparse
+import json
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPLY = (
+    "Hi there! I'm instaCanva⚡, your creative sidekick. I can create designs, list and export them, "
+    "upload your assets and brainstorm ideas for your next Canva project. What shall we make today? "
+    "Input: this part is cut off by the stop sequence"
+)
+
+
+class MockState:
+    """Latency settings and in-progress jobs shared by all request handlers."""
+
+    def __init__(self, export_latency=2.0, upload_latency=0.5, api_latency=0.05,
+                 generation_latency=1.5, token_delay=0.02, designs_per_page=5):
+        self.export_latency = export_latency
+        self.upload_latency = upload_latency
+        self.api_latency = api_latency
+        self.generation_latency = generation_latency
+        self.token_delay = token_delay
+        self.designs_per_page = designs_per_page
+        self.jobs = {}
+        self.assets = set()
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def start_job(self, kind):
+        job_id = uuid.uuid4().hex
+        with self.lock:
+            self.jobs[job_id] = (kind, time.time())
+        return job_id
+
+    def job_done(self, job_id, latency):
+        with self.lock:
+            started = self.jobs.get(job_id, (None, 0))[1]
+        return time.time() - started >= latency
+
+    def count(self, route):
+        with self.lock:
+            self.counts[route] = self.counts.get(route, 0) + 1
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; Nagle would hold the body back for an ACK
+    disable_nagle_algorithm = True
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = self.headers.get('Content-Length')
+        if length is not None:
+            return self.rfile.read(int(length))
+        # Chunked upload (a streamed body without a known size)
+        body = b''
+        while True:
+            size = int(self.rfile.readline().split(b';')[0], 16)
+            if size == 0:
+                self.rfile.readline()
+                return body
+            body += self.rfile.read(size)
+            self.rfile.readline()
+
+    def do_GET(self):
+        self.route('GET')
+
+    def do_POST(self):
+        self.route('POST')
+
+    def route(self, method):
+        state = self.state
+        path = self.path.split('?', 1)[0]
+        body = self.read_body() if method == 'POST' else b''
+
+        for pattern, route_method, handler in ROUTES:
+            match = re.fullmatch(pattern, path)
+            if match and route_method == method:
+                state.count(handler.__name__)
+                return handler(self, state, body, **match.groupdict())
+        self.send_json({'error': f'no mock for {method} {path}'}, 404)
+
+    # Canva
+
+    def canva_token(self, state, body):
+        self.send_json({'access_token': f'mock-{uuid.uuid4().hex}', 'refresh_token': uuid.uuid4().hex, 'expires_in': 14400})
+
+    def canva_list_designs(self, state, body):
+        time.sleep(state.api_latency)
+        items = [
+            {
+                'id': f'D{number}', 'title': f'Design {number}', 'updated_at': 1700000000 - number,
+                'thumbnail': {'url': f'http://{self.headers["Host"]}/media/20000?design=D{number}'},
+            }
+            for number in range(1, state.designs_per_page + 1)
+        ]
+        self.send_json({'items': items})
+
+    def canva_get_design(self, state, body, design_id):
+        time.sleep(state.api_latency)
+        self.send_json({'design': {'id': design_id, 'title': f'Design {design_id}', 'updated_at': 1700000000}})
+
+    def canva_create_design(self, state, body):
+        time.sleep(state.api_latency)
+        self.send_json({'design': {'id': uuid.uuid4().hex, 'title': json.loads(body or b'{}').get('title')}})
+
+    def canva_create_export(self, state, body):
+        time.sleep(state.api_latency)
+        self.send_json({'job': {'id': state.start_job('export'), 'status': 'in_progress'}})
+
+    def canva_export_status(self, state, body, job_id):
+        if state.job_done(job_id, state.export_latency):
+            url = f'http://{self.headers["Host"]}/media/50000?job={job_id}&Expires={int(time.time()) + 86400}'
+            self.send_json({'job': {'id': job_id, 'status': 'success', 'urls': [url]}})
+        else:
+            self.send_json({'job': {'id': job_id, 'status': 'in_progress'}})
+
+    def canva_create_upload(self, state, body):
+        self.send_json({'job': {'id': state.start_job('upload'), 'status': 'in_progress'}})
+
+    def canva_upload_status(self, state, body, job_id):
+        if state.job_done(job_id, state.upload_latency):
+            state.assets.add(f'A{job_id[:8]}')
+            self.send_json({'job': {'id': job_id, 'status': 'success', 'asset': {'id': f'A{job_id[:8]}'}}})
+        else:
+            self.send_json({'job': {'id': job_id, 'status': 'in_progress'}})
+
+    def canva_get_asset(self, state, body, asset_id):
+        time.sleep(state.api_latency)
+        if asset_id in state.assets:
+            self.send_json({'asset': {'id': asset_id, 'name': 'My Awesome Upload'}})
+        else:
+            self.send_json({'code': 'not_found', 'message': f'Asset {asset_id} not found'}, 404)
+
+    # IBM
+
+    def iam_token(self, state, body):
+        self.send_json({'access_token': f'iam-{uuid.uuid4().hex}', 'expiration': int(time.time()) + 3600})
+
+    def generated_tokens(self, body):
+        """Words of the canned reply, cut at the first stop sequence and at max_new_tokens like Watsonx does."""
+        request = json.loads(body or b'{}')
+        parameters = request.get('parameters', {})
+        words = re.findall(r'\S+\s*', REPLY)
+        tokens = []
+        stop_reason = 'eos_token'
+        for word in words:
+            if any(word.startswith(stop) for stop in parameters.get('stop_sequences', [])):
+                stop_reason = 'stop_sequence'
+                break
+            if len(tokens) >= parameters.get('max_new_tokens', len(words)):
+                stop_reason = 'max_tokens'
+                break
+            tokens.append(word)
+        # Roughly four characters per token
+        return tokens, len(request.get('input', '')) // 4, stop_reason
+
+    def watsonx_generate(self, state, body):
+        tokens, input_token_count, stop_reason = self.generated_tokens(body)
+        # Generation time grows with the number of tokens actually produced
+        time.sleep(state.generation_latency * len(tokens) / len(re.findall(r'\S+\s*', REPLY)))
+        self.send_json({'results': [{
+            'generated_text': ''.join(tokens), 'generated_token_count': len(tokens),
+            'input_token_count': input_token_count, 'stop_reason': stop_reason,
+        }]})
+
+    def watsonx_generate_stream(self, state, body):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        tokens, input_token_count, stop_reason = self.generated_tokens(body)
+        try:
+            for count, word in enumerate(tokens, 1):
+                time.sleep(state.token_delay)
+                result = {'generated_text': word, 'generated_token_count': count, 'input_token_count': input_token_count}
+                if count == len(tokens):
+                    result['stop_reason'] = stop_reason
+                event = json.dumps({'results': [result]})
+                self.wfile.write(f'id: 1\nevent: message\ndata: {event}\n\n'.encode('utf-8'))
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The app hangs up as soon as it sees a new "Input:" turn (requests without stop sequences)
+            pass
+
+    # Twilio, SendGrid and media downloads
+
+    def twilio_message(self, state, body, account_sid):
+        time.sleep(state.api_latency)
+        self.send_json({'sid': f'SM{uuid.uuid4().hex}', 'account_sid': account_sid, 'status': 'queued'}, 201)
+
+    def sendgrid_send(self, state, body):
+        self.send_response(202)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def media(self, state, body, size):
+        payload = b'\0' * int(size)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 resets connections as soon as the app opens a burst of them
+    request_queue_size = 1024
+
+
+ROUTES = [
+    (r'/canva/oauth/token', 'POST', MockHandler.canva_token),
+    (r'/canva/designs', 'GET', MockHandler.canva_list_designs),
+    (r'/canva/designs', 'POST', MockHandler.canva_create_design),
+    (r'/canva/designs/(?P<design_id>[^/]+)', 'GET', MockHandler.canva_get_design),
+    (r'/canva/exports', 'POST', MockHandler.canva_create_export),
+    (r'/canva/exports/(?P<job_id>[^/]+)', 'GET', MockHandler.canva_export_status),
+    (r'/canva/asset-uploads', 'POST', MockHandler.canva_create_upload),
+    (r'/canva/asset-uploads/(?P<job_id>[^/]+)', 'GET', MockHandler.canva_upload_status),
+    (r'/canva/assets/(?P<asset_id>[^/]+)', 'GET', MockHandler.canva_get_asset),
+    (r'/iam/identity/token', 'POST', MockHandler.iam_token),
+    (r'/watsonx/ml/v1/text/generation', 'POST', MockHandler.watsonx_generate),
+    (r'/watsonx/ml/v1/text/generation_stream', 'POST', MockHandler.watsonx_generate_stream),
+    (r'/twilio/2010-04-01/Accounts/(?P<account_sid>[^/]+)/Messages\.json', 'POST', MockHandler.twilio_message),
+    (r'/sendgrid/v3/mail/send', 'POST', MockHandler.sendgrid_send),
+    (r'/media/(?P<size>\d+)', 'GET', MockHandler.media),
+]
+
+
+def mock_environment(base):
+    """Environment that points the app at stand-ins served from base."""
+    return {
+        'CANVA_API_URL': f'{base}/canva',
+        'IBM_IAM_URL': f'{base}/iam',
+        'WATSONX_URL': f'{base}/watsonx',
+        'TWILIO_BASE_URL': f'{base}/twilio',
+        'SENDGRID_API_URL': f'{base}/sendgrid',
+        'IBM_API_KEY': 'mock',
+        'TWILIO_ACCOUNT_SID': 'ACmock',
+        'TWILIO_AUTH_TOKEN': 'mock',
+        'TWILIO_PHONE_NO': '+15550000000',
+        'SENDGRID_API_KEY': 'mock',
+        'SENDGRID_MAIL': 'bot@example.com',
+        'RECIPIENT_MAIL': 'admin@example.com',
+    }
+
+
+def start_mock_upstreams(port=0, **settings):
+    """Start the stand-in server on a background thread, returning (server, state, env)."""
+    state = MockState(**settings)
+    handler = type('BoundMockHandler', (MockHandler,), {'state': state})
+    server = MockServer(('127.0.0.1', port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state, mock_environment(f'http://127.0.0.1:{server.server_port}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--export-latency', type=float, default=2.0, help='seconds until an export job succeeds')
+    parser.add_argument('--upload-latency', type=float, default=0.5, help='seconds until an asset upload job succeeds')
+    parser.add_argument('--api-latency', type=float, default=0.05, help='delay of plain Canva and Twilio calls')
+    parser.add_argument('--generation-latency', type=float, default=1.5, help='delay of a non-streamed Watsonx reply')
+    parser.add_argument('--token-delay', type=float, default=0.02, help='delay between streamed Watsonx tokens')
+    args = parser.parse_args()
+
+    server, state, env = start_mock_upstreams(
+        args.port, export_latency=args.export_latency, upload_latency=args.upload_latency,
+        api_latency=args.api_latency, generation_latency=args.generation_latency, token_delay=args.token_delay,
+    )
+    for name, value in env.items():
+        print(f'export {name}={value}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+"""Replies to canned prompts are shared by every sender, whatever they said before."""
+import os
+import sys
+import tempfile
+
+os.environ.setdefault('DATABASE_PATH', os.path.join(tempfile.mkdtemp(prefix='instacanva-test-'), 'instacanva.db'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app  # noqa: E402
+
+
+def test_help_prompts_hit_the_cache_across_conversations(monkeypatch):
+    generated = []
+
+    def generate_reply(chat):
+        generated.append(chat)
+        return "I can create, find and export your Canva designs."
+
+    monkeypatch.setattr(app.blocking_io, 'generate_reply', generate_reply)
+    with app.app.app_context():
+        app.chat_history.add('whatsapp:+15550000001', 'ideas for a bake sale poster', 'Try a pastel palette.')
+        app.chat_history.add('whatsapp:+15550000002', 'what is canva', 'Canva is a design tool.')
+
+        first = app.run_steps(app.handle_natural_language_input_steps(app.blocking_io, 'What can you do?', 'whatsapp:+15550000001'))
+        second = app.run_steps(app.handle_natural_language_input_steps(app.blocking_io, 'what can  you do?', 'whatsapp:+15550000002'))
+
+    assert first == second
+    assert len(generated) == 1
+    assert generated[0].history == ()
+
+
+def test_other_prompts_keep_their_history():
+    with app.app.app_context():
+        app.chat_history.add('whatsapp:+15550000003', 'ideas for a bake sale poster', 'Try a pastel palette.')
+        chat = app.chat_request('make it blue', 'whatsapp:+15550000003')
+
+    assert chat.history
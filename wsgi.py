@@ -1,5 +1,4 @@
 from waitress import serve
 import app
 
-serve(app, host='0.0.0.0', port=8000)
-
+serve(app.app, host='0.0.0.0', port=8000, threads=app.WEB_THREADS)